@@ -29,6 +29,10 @@ setup(
         'Flask',
         'Flask-Mako',
     ],
+    extras_require={
+        'redis': ['redis'],
+        'gevent': ['gevent'],
+    },
     entry_points="""
     [console_scripts]
     flask-ctl = presence_analyzer.script:run
@@ -37,5 +41,10 @@ setup(
     [paste.app_factory]
     main = presence_analyzer.script:make_app
     debug = presence_analyzer.script:make_debug
+    background = presence_analyzer.script:make_background
+
+    [paste.server_runner]
+    prefork = presence_analyzer.prefork:server_runner
+    gevent = presence_analyzer.asyncserver:server_runner
     """,
 )
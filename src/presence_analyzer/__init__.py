@@ -1,4 +1,2 @@
 # -*- coding: utf-8 -*-
 """__init__"""
-from .main import app
-from . import views
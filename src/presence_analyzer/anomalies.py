@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Detecting unusual start and end times of presence.
+
+Every user has running mean and variance of start and end time per weekday,
+updated with Welford's method as days are read in date order. A day is
+flagged when its time is further than 'threshold' standard deviations from
+the mean of the previous days.
+"""
+
+import math
+
+
+class RunningStats(object):
+    """
+    Running mean and variance, updated one value at a time.
+    """
+    __slots__ = ('count', 'mean', 'm2')
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value):
+        """
+        Includes value in the statistics.
+        """
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def deviation(self):
+        """
+        Returns sample standard deviation, zero for less than two values.
+        """
+        if self.count < 2:
+            return 0.0
+        return math.sqrt(self.m2 / (self.count - 1))
+
+
+class AnomalyDetector(object):
+    """
+    Flags start and end times far from user's norm for the weekday.
+
+    Norm is known after 'min_samples' days, anomalies are listed in
+    'anomalies' attribute in order of detection. Days of a user have to be
+    added in date order, see add_user().
+    """
+
+    def __init__(self, threshold=3, min_samples=5):
+        self.threshold = threshold
+        self.min_samples = max(min_samples, 2)
+        self.stats = {}
+        self.anomalies = []
+
+    def add(self, user_id, day, start, end):
+        """
+        Checks presence entry against the norm and includes it in the norm.
+        """
+        values = (
+            ('start', start.hour * 3600 + start.minute * 60 + start.second),
+            ('end', end.hour * 3600 + end.minute * 60 + end.second),
+        )
+        for field, value in values:
+            key = (user_id, day.weekday(), field)
+            stats = self.stats.get(key)
+            if stats is None:
+                stats = self.stats[key] = RunningStats()
+            if stats.count >= self.min_samples:
+                deviation = stats.deviation()
+                if deviation and \
+                        abs(value - stats.mean) > self.threshold * deviation:
+                    self.anomalies.append({
+                        'user_id': user_id,
+                        'date': day.isoformat(),
+                        'field': field,
+                        'value': value,
+                        'mean': round(stats.mean),
+                        'score': round((value - stats.mean) / deviation, 2),
+                    })
+            stats.add(value)
+
+    def add_user(self, user_id, items):
+        """
+        Checks all presence entries of a user, in date order.
+        """
+        for day in sorted(items):
+            self.add(user_id, day, items[day]['start'], items[day]['end'])
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Asynchronous server keeping idle keep-alive connections off the threads.
+
+Connections are served by gevent greenlets of one event loop, so every
+open connection doesn't hold a thread of the pool like in the threaded
+server. Application runs in a pool of real threads, see Offload, so
+computing responses doesn't stop the event loop. Nothing is monkey
+patched, locks, the data watcher and background tasks stay real threads.
+It needs the gevent package.
+"""
+
+import socket
+
+from paste.deploy.converters import asint
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=C0103
+
+
+class Offload(object):
+    """
+    WSGI middleware running the application in a thread pool.
+
+    Takes gevent thread pool, the event loop waits for the application
+    without blocking other connections. Body of known length is read at
+    once, so it's sent together with headers. Streamed body is produced in
+    the pool chunk by chunk, so exports don't block the event loop either.
+    """
+
+    def __init__(self, application, threadpool):
+        self.application = application
+        self.threadpool = threadpool
+
+    def __call__(self, environ, start_response):
+        return self.threadpool.apply(self.start, (environ, start_response))
+
+    def start(self, environ, start_response):
+        """
+        Calls the application, returns its response body.
+        """
+        sized = []
+
+        def capture(status, headers, exc_info=None):
+            """
+            Notes whether response tells its length.
+            """
+            sized.append(
+                any(name.lower() == 'content-length' for name, _ in headers)
+            )
+            return start_response(status, headers, exc_info)
+
+        result = self.application(environ, capture)
+        if not sized or not sized[-1]:
+            return self.body(result)
+        try:
+            return [''.join(result)]
+        finally:
+            close = getattr(result, 'close', None)
+            if close is not None:
+                close()
+
+    def body(self, result):
+        """
+        Yields chunks of streamed response body, reading them in the pool.
+        """
+        chunks = iter(result)
+        try:
+            while True:
+                chunk = self.threadpool.apply(next, (chunks, None))
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            close = getattr(result, 'close', None)
+            if close is not None:
+                self.threadpool.apply(close)
+
+
+def make_server(wsgi_app, host='127.0.0.1', port=8080, connections=1000,
+                threads=10):
+    """
+    Creates gevent WSGI server of the application, see server_runner().
+    """
+    from gevent.pool import Pool
+    from gevent.pywsgi import WSGIServer, WSGIHandler
+    from gevent.threadpool import ThreadPool
+
+    class Handler(WSGIHandler):
+        """
+        Connection handler sending responses without Nagle's delay.
+
+        Headers and body are written separately, with Nagle's algorithm the
+        body would wait for delayed acknowledgement of keep-alive client.
+        """
+
+        def handle(self):
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            return WSGIHandler.handle(self)
+
+    return WSGIServer(
+        (host, port),
+        Offload(wsgi_app, ThreadPool(threads)),
+        spawn=Pool(connections),
+        handler_class=Handler,
+        log=None,
+        error_log=log,
+    )
+
+
+def server_runner(wsgi_app, global_conf, **kwargs):  # pylint: disable=W0613
+    """
+    Paste server runner, configured in [server:gevent] section.
+
+    Options:
+     - 'host' and 'port' the server listens on,
+     - 'connections' is the most connections served at once,
+     - 'threads' is the number of threads running the application.
+    """
+    server = make_server(
+        wsgi_app,
+        kwargs.get('host', '127.0.0.1'),
+        asint(kwargs.get('port', 8080)),
+        asint(kwargs.get('connections', 1000)),
+        asint(kwargs.get('threads', 10)),
+    )
+    log.info('Serving on http://%s:%s', *server.address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+"""
+Cache backends shared by processes of one host.
+
+Backend is chosen by CACHE_BACKEND setting:
+ - 'memory://' keeps values in the process, mostly for tests,
+ - 'file:///dev/shm/presence_analyzer' keeps pickled values in files of
+   given directory, guarded by file locks,
+ - 'redis://localhost:6379/0' keeps pickled values in Redis, it needs
+   the redis package.
+"""
+
+import os
+import time
+import uuid
+import errno
+import fcntl
+import hashlib
+import cPickle as pickle
+from threading import Lock
+from contextlib import contextmanager
+from urlparse import urlparse
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=C0103
+
+
+class CacheBackend(object):
+    """
+    Interface of cache backends.
+
+    Values are any picklable objects, None stands for missing value.
+    """
+
+    def get(self, key):
+        """
+        Returns value of the key, None if it's missing or expired.
+        """
+        raise NotImplementedError()
+
+    def set(self, key, value, timeout=None):
+        """
+        Stores value of the key, for 'timeout' seconds if given.
+        """
+        raise NotImplementedError()
+
+    def incr(self, key):
+        """
+        Increments counter of the key, returns its new value.
+        """
+        raise NotImplementedError()
+
+    def lock(self, key):
+        """
+        Returns context manager holding exclusive lock of the key.
+        """
+        raise NotImplementedError()
+
+
+class MemoryBackend(CacheBackend):
+    """
+    Backend keeping values in the process.
+    """
+
+    def __init__(self, sweep_interval=60):
+        self.values = {}
+        self.locks = {}
+        self.guard = Lock()
+        self.sweep_interval = sweep_interval
+        self.swept = time.time()
+
+    def get(self, key):
+        expires, value = self.values.get(key, (None, None))
+        if expires is not None and expires < time.time():
+            self.values.pop(key, None)
+            return None
+        return value
+
+    def set(self, key, value, timeout=None):
+        now = time.time()
+        expires = now + timeout if timeout else None
+        self.values[key] = (expires, value)
+        if now - self.swept > self.sweep_interval:
+            self.sweep()
+
+    def sweep(self):
+        """
+        Removes expired values.
+        """
+        self.swept = now = time.time()
+        for key, (expires, value) in self.values.items():
+            if expires is not None and expires < now:
+                self.values.pop(key, None)
+
+    def incr(self, key):
+        with self.guard:
+            value = (self.get(key) or 0) + 1
+            self.set(key, value)
+        return value
+
+    def lock(self, key):
+        with self.guard:
+            return self.locks.setdefault(key, Lock())
+
+
+class FileBackend(CacheBackend):
+    """
+    Backend keeping pickled values in files of given directory.
+
+    Files are replaced at once, locks are flock()-ed lock files, so they
+    work across processes. Directory in /dev/shm keeps values in memory.
+    Expired files are removed when they're read and by sweep(), which runs
+    at most every 'sweep_interval' seconds when a value is stored.
+    """
+
+    def __init__(self, directory, sweep_interval=60):
+        self.directory = directory
+        self.sweep_interval = sweep_interval
+        self.swept = time.time()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, key, extension=''):
+        """
+        Returns path of the file holding the key.
+        """
+        name = hashlib.sha1(key).hexdigest()
+        return os.path.join(self.directory, name + extension)
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as valuefile:
+                if self.expired(valuefile):
+                    value = None
+                else:
+                    return pickle.load(valuefile)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+        self.remove(path)
+        return value
+
+    def set(self, key, value, timeout=None):
+        now = time.time()
+        expires = now + timeout if timeout else None
+        path = self.path(key)
+        temp_path = '{0}.{1}.tmp'.format(path, uuid.uuid4().hex)
+        with open(temp_path, 'wb') as valuefile:
+            # expiry goes first, so it's read without the value
+            pickle.dump(expires, valuefile, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(value, valuefile, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_path, path)
+        if now - self.swept > self.sweep_interval:
+            self.sweep()
+
+    @staticmethod
+    def expired(valuefile):
+        """
+        Reads expiry time from value file, tells whether it has passed.
+        """
+        expires = pickle.load(valuefile)
+        return expires is not None and expires < time.time()
+
+    def sweep(self):
+        """
+        Removes files of expired values.
+        """
+        self.swept = time.time()
+        for name in os.listdir(self.directory):
+            if '.' in name:
+                # lock and temporary files
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path, 'rb') as valuefile:
+                    if not self.expired(valuefile):
+                        continue
+            except (IOError, EOFError, pickle.UnpicklingError):
+                continue
+            self.remove(path)
+
+    def remove(self, path):
+        """
+        Removes expired value file and its lock file.
+
+        Files are kept while the value is locked or was stored again.
+        """
+        lock_path = path + '.lock'
+        with open(lock_path, 'a') as lockfile:
+            try:
+                fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as error:
+                if error.errno in (errno.EAGAIN, errno.EACCES):
+                    return
+                raise
+            try:
+                if self.remove_expired(path):
+                    os.remove(lock_path)
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def remove_expired(self, path):
+        """
+        Removes value file if it's expired, tells whether it's gone.
+        """
+        try:
+            with open(path, 'rb') as valuefile:
+                if not self.expired(valuefile):
+                    return False
+            os.remove(path)
+        except (IOError, OSError) as error:
+            if error.errno != errno.ENOENT:
+                log.debug('Could not remove %s', path, exc_info=True)
+                return False
+        except (EOFError, pickle.UnpicklingError):
+            return False
+        return True
+
+    def incr(self, key):
+        with self.lock(key):
+            value = (self.get(key) or 0) + 1
+            self.set(key, value)
+        return value
+
+    @contextmanager
+    def lock(self, key):
+        with open(self.path(key, '.lock'), 'a') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+class RedisBackend(CacheBackend):
+    """
+    Backend keeping pickled values in Redis.
+
+    Takes client with redis-py StrictRedis interface. Locks expire after
+    'lock_timeout' seconds, so crashed process doesn't hold them forever.
+    """
+
+    def __init__(self, client, prefix='presence_analyzer:', lock_timeout=60):
+        self.client = client
+        self.prefix = prefix
+        self.lock_timeout = lock_timeout
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            return None
+        return pickle.loads(value)
+
+    def set(self, key, value, timeout=None):
+        self.client.set(
+            self.prefix + key,
+            pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+            ex=timeout
+        )
+
+    def incr(self, key):
+        return self.client.incr(self.prefix + key)
+
+    @contextmanager
+    def lock(self, key):
+        name = self.prefix + key + ':lock'
+        token = uuid.uuid4().hex
+        while not self.client.set(name, token, nx=True, ex=self.lock_timeout):
+            time.sleep(0.05)
+        try:
+            yield
+        finally:
+            if self.client.get(name) == token:
+                self.client.delete(name)
+
+
+def make_backend(url):
+    """
+    Creates backend described by URL, see module description.
+    """
+    parsed = urlparse(url)
+    if parsed.scheme == 'memory':
+        return MemoryBackend()
+    if parsed.scheme == 'file':
+        return FileBackend(parsed.path)
+    if parsed.scheme == 'redis':
+        import redis
+        return RedisBackend(redis.StrictRedis.from_url(url))
+    raise ValueError('Unknown cache backend: {0}'.format(url))
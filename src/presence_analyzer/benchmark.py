@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Load test of a running server over many keep-alive connections.
+
+Every client thread keeps its connection open and sends requests one
+after another, like browsers polling the API do. Running it against the
+threaded and the asynchronous server shows how they scale with open
+connections, see flask-ctl benchmark.
+"""
+
+import time
+import httplib
+from threading import Thread
+from urlparse import urlparse
+
+
+def run_client(url, requests, latencies, errors):
+    """
+    Sends requests to URL over one connection, records their latencies.
+    """
+    parsed = urlparse(url)
+    path = parsed.path + ('?' + parsed.query if parsed.query else '')
+    connection = httplib.HTTPConnection(parsed.hostname, parsed.port or 80,
+                                        timeout=60)
+    try:
+        for i in range(requests):  # pylint: disable=W0612
+            started = time.time()
+            connection.request('GET', path)
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                errors.append(response.status)
+                continue
+            latencies.append(time.time() - started)
+    except (IOError, httplib.HTTPException) as error:
+        errors.append(error)
+    finally:
+        connection.close()
+
+
+def percentile(values, part):
+    """
+    Returns value below which given part of sorted values falls.
+    """
+    if not values:
+        return 0
+    return values[min(int(len(values) * part), len(values) - 1)]
+
+
+def benchmark(url, connections=100, requests=10):
+    """
+    Requests URL over given number of connections at once.
+
+    Returns number of requests served per second, mean, median and 99th
+    percentile latency in seconds and number of failed requests.
+    """
+    latencies = []
+    errors = []
+    clients = [
+        Thread(target=run_client, args=(url, requests, latencies, errors))
+        for i in range(connections)
+    ]
+    started = time.time()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.time() - started
+
+    latencies.sort()
+    return {
+        'connections': connections,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'rate': len(latencies) / elapsed if elapsed else 0,
+        'mean': sum(latencies) / len(latencies) if latencies else 0,
+        'median': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+    }
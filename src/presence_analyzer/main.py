@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 """
 Flask app initialization.
+
+Package doesn't import the app, so command line tools stay light. Views are
+registered by importing presence_analyzer.views.
 """
 from flask import Flask
 from flask.ext.mako import MakoTemplates
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+Pre-forking HTTP server.
+
+The parent process binds the listening socket and loads presence data once,
+then forks worker processes which share the parsed data copy-on-write and
+accept connections on the inherited socket.
+
+Data is only ever loaded by the parent, workers which would load it again
+wouldn't share it anymore. Signals understood by the parent process:
+ - SIGHUP reloads data and heavy modules and gracefully replaces workers,
+ - SIGUSR1 refreshes presence data and gracefully replaces workers,
+ - SIGUSR2 gracefully replaces workers with ones sharing current data,
+ - SIGTERM and SIGINT gracefully stop all workers and exit.
+
+When data files are watched, their changes refresh data in the parent,
+which then replaces workers.
+"""
+
+import os
+import time
+import errno
+import signal
+import threading
+
+from paste.httpserver import serve
+from paste.deploy.converters import asint
+
+from presence_analyzer import utils
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=C0103
+
+SIGNALS = (
+    signal.SIGHUP,
+    signal.SIGUSR1,
+    signal.SIGUSR2,
+    signal.SIGTERM,
+    signal.SIGINT,
+)
+
+
+def serve_worker(server):
+    """
+    Handles requests until worker receives SIGTERM.
+
+    Requests in progress are finished before the worker exits. Control
+    signals are meant for the parent, workers ignore them.
+    """
+    state = {'running': True}
+
+    def stop(signum, frame):  # pylint: disable=W0613
+        """
+        Stops accepting connections after current request.
+        """
+        state['running'] = False
+
+    for signum in SIGNALS:
+        signal.signal(signum, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    server.timeout = 1
+    while state['running']:
+        try:
+            server.handle_request()
+        except (OSError, IOError) as error:
+            if error.errno != errno.EINTR:
+                raise
+    server.server_close()
+    for thread in threading.enumerate():
+        if thread is not threading.current_thread():
+            thread.join()
+
+
+def spawn_worker(server):
+    """
+    Forks worker process, returns its pid in the parent.
+
+    Data locks are held while forking, so the worker doesn't inherit a lock
+    held by another thread of the parent, like the data watcher.
+    """
+    with utils.LOCK, utils.SNAPSHOT_LOCK:
+        pid = os.fork()
+    if pid:
+        return pid
+    status = 0
+    try:
+        serve_worker(server)
+    except Exception:  # pylint: disable=W0703
+        log.exception('Worker %d crashed', os.getpid())
+        status = 1
+    finally:
+        os._exit(status)  # pylint: disable=W0212
+
+
+def signal_workers(workers, signum):
+    """
+    Sends signal to all given worker processes.
+    """
+    for pid in workers:
+        try:
+            os.kill(pid, signum)
+        except OSError as error:
+            if error.errno != errno.ESRCH:
+                raise
+
+
+def replace_workers(server, processes, workers, retiring):
+    """
+    Forks new workers, gracefully stops the old ones.
+
+    Returns pids of new workers, old ones are added to 'retiring'.
+    """
+    retiring.update(workers)
+    workers = set(spawn_worker(server) for i in range(processes))
+    signal_workers(retiring, signal.SIGTERM)
+    return workers
+
+
+def serve_forever(server, processes):
+    """
+    Keeps given amount of workers alive and handles control signals.
+    """
+    received = []
+
+    def handler(signum, frame):  # pylint: disable=W0613
+        """
+        Queues signal, it's handled in the main loop.
+        """
+        received.append(signum)
+
+    for signum in SIGNALS:
+        signal.signal(signum, handler)
+
+    workers = set(spawn_worker(server) for i in range(processes))
+    retiring = set()
+    stopping = False
+    log.info('Started %d workers', processes)
+    while workers or retiring:
+        while received:
+            signum = received.pop(0)
+            if signum in (signal.SIGTERM, signal.SIGINT):
+                log.info('Stopping workers')
+                stopping = True
+                signal_workers(workers | retiring, signal.SIGTERM)
+            elif stopping:
+                continue
+            elif signum == signal.SIGHUP:
+                log.info('Reloading workers')
+                utils.warm_up(force=True)
+                workers = replace_workers(server, processes, workers,
+                                          retiring)
+            elif signum == signal.SIGUSR1:
+                log.info('Refreshing data and replacing workers')
+                utils.get_data.refresh()
+                workers = replace_workers(server, processes, workers,
+                                          retiring)
+            elif signum == signal.SIGUSR2:
+                log.info('Replacing workers')
+                workers = replace_workers(server, processes, workers,
+                                          retiring)
+
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError as error:
+            if error.errno == errno.EINTR:
+                continue
+            raise
+        if not pid:
+            time.sleep(1)
+        elif pid in retiring:
+            retiring.discard(pid)
+        elif pid in workers:
+            workers.discard(pid)
+            if not stopping:
+                log.warning('Worker %d exited (%d), spawning new one',
+                            pid, status)
+                workers.add(spawn_worker(server))
+    server.server_close()
+
+
+def notify_workers(paths):
+    """
+    Refreshes data of changed files in the parent, then replaces workers.
+    """
+    utils.refresh_changed(paths)
+    os.kill(os.getpid(), signal.SIGUSR2)
+
+
+def server_runner(wsgi_app, global_conf, **kwargs):  # pylint: disable=W0613
+    """
+    Paste server runner, configured in [server:prefork] section.
+
+    Options:
+     - 'host' and 'port' the server listens on,
+     - 'processes' is the number of forked worker processes,
+     - 'request_queue_size' is the listen backlog of the shared socket.
+    """
+    processes = asint(kwargs.pop('processes', 4))
+    kwargs['request_queue_size'] = asint(
+        kwargs.pop('request_queue_size', 5)
+    )
+    server = serve(
+        wsgi_app,
+        use_threadpool=False,
+        start_loop=False,
+        **kwargs
+    )
+    utils.warm_up()
+    if utils.WATCHER is not None:
+        # watcher thread isn't forked, workers are refreshed by the parent
+        utils.WATCHER.callback = notify_workers
+    serve_forever(server, processes)
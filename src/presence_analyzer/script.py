@@ -6,7 +6,6 @@ import os
 import sys
 from functools import partial
 
-import paste.script.command
 import werkzeug.script
 
 etc = partial(os.path.join, 'parts', 'etc')
@@ -26,17 +25,33 @@ del _buildout_path
 
 
 # bin/paster serve parts/etc/deploy.ini
-def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
-    from presence_analyzer import app
+def make_app(global_conf={}, config=DEPLOY_CFG, debug=False, warm_up=False):
+    from paste.deploy.converters import asbool
+    from presence_analyzer.main import app
+    from presence_analyzer import views
     app.config.from_pyfile(abspath(config))
     app.debug = debug
+    if app.config.get('WATCH_DATA'):
+        from presence_analyzer import utils
+        utils.watch_data()
+    if asbool(warm_up):
+        from presence_analyzer import utils
+        utils.warm_up()
+    return app
+
+
+# [app:main] use = egg:presence_analyzer#background
+def make_background(global_conf={}, **conf):
+    from presence_analyzer.tasks import start_refresh
+    app = make_app(global_conf, **conf)
+    start_refresh(app.config.get('REFRESH_INTERVAL', 300))
     return app
 
 
 # bin/paster serve parts/etc/debug.ini
 def make_debug(global_conf={}, **conf):
     from werkzeug.debug import DebuggedApplication
-    app = make_app(global_conf, config=DEBUG_CFG, debug=True)
+    app = make_app(global_conf, config=DEBUG_CFG, debug=True, **conf)
     return DebuggedApplication(app, evalex=True)
 
 
@@ -50,13 +65,17 @@ def make_shell():
     return locals()
 
 
-def _serve(action, debug=False, dry_run=False):
-    """Build paster command from 'action' and 'debug' flag."""
+def _serve(action, debug=False, dry_run=False, prefork=False, gevent=False):
+    """Build paster command from 'action', 'debug' and server flags."""
     if debug:
         config = DEBUG_INI
     else:
         config = DEPLOY_INI
     argv = ['bin/paster', 'serve', config]
+    if prefork:
+        argv += ['--server-name', 'prefork']
+    elif gevent:
+        argv += ['--server-name', 'gevent']
     if action in ('start', 'restart'):
         argv += [action, '--daemon']
     elif action in ('', 'fg', 'foreground'):
@@ -75,6 +94,7 @@ def _serve(action, debug=False, dry_run=False):
         ]
     sys.argv = argv[:2] + [abspath(config)] + argv[3:]
     # Run the 'paster' command
+    import paste.script.command
     paste.script.command.run()
 
 
@@ -83,7 +103,8 @@ def run():
     action_shell = werkzeug.script.make_shell(make_shell, make_shell.__doc__)
 
     # bin/flask-ctl serve [fg|start|stop|restart|status]
-    def action_serve(action=('a', 'start'), dry_run=False):
+    def action_serve(action=('a', 'start'), dry_run=False, prefork=False,
+                     gevent=False):
         """Serve the application.
 
         This command serves a web application that uses a paste.deploy
@@ -92,14 +113,52 @@ def run():
         Options:
          - 'action' is one of [fg|start|stop|restart|status]
          - '--dry-run' print the paster command and exit
+         - '--prefork' serve from pre-forked worker processes
+         - '--gevent' serve keep-alive connections from gevent event loop
         """
-        _serve(action, debug=False, dry_run=dry_run)
+        _serve(action, debug=False, dry_run=dry_run, prefork=prefork,
+               gevent=gevent)
 
     # bin/flask-ctl debug [fg|start|stop|restart|status]
     def action_debug(action=('a', 'start'), dry_run=False):
         """Serve the debugging application."""
         _serve(action, debug=True, dry_run=dry_run)
 
+    # bin/flask-ctl precompute
+    def action_precompute(processes=0):
+        """Precompute statistics of all users.
+
+        Statistics are stored in DATA_STATS file and served by the
+        application as long as DATA_CSV doesn't change.
+
+        Options:
+         - '--processes' number of worker processes, defaults to CPU count
+        """
+        from presence_analyzer.utils import dump_statistics
+        app = make_app()
+        users = dump_statistics(app.config['DATA_STATS'], processes or None)
+        print 'Precomputed statistics of %d users' % len(users)
+
+    # bin/flask-ctl benchmark
+    def action_benchmark(url='http://localhost:8182/api/v1/users',
+                         connections=100, requests=10):
+        """Load test running server over many keep-alive connections.
+
+        Run it against the server started with and without '--gevent'.
+
+        Options:
+         - '--url' requested URL
+         - '--connections' number of connections open at once
+         - '--requests' number of requests sent over each connection
+        """
+        from presence_analyzer.benchmark import benchmark
+        result = benchmark(url, connections, requests)
+        print ('%(requests)d requests over %(connections)d connections, '
+               '%(errors)d failed' % result)
+        print '%.1f requests/s' % result['rate']
+        print ('latency mean %(mean).3fs, median %(median).3fs, '
+               '99%% %(p99).3fs' % result)
+
     # bin/flask-ctl status
     def action_status(dry_run=False):
         """Status of the application."""
@@ -3,3 +3,20 @@ function parseToDate(value) {
         result.setMilliseconds(value*1000);
         return result;
 }
+
+// Pin all requests of the page to one generation of presence data,
+// so charts don't mix data loaded before and after a refresh.
+(function($) {
+        var dataGeneration = null;
+        $(document).ajaxSend(function(event, xhr) {
+                if(dataGeneration !== null) {
+                        xhr.setRequestHeader('X-Data-Generation', dataGeneration);
+                }
+        });
+        $(document).ajaxComplete(function(event, xhr) {
+                var generation = xhr.getResponseHeader('X-Data-Generation');
+                if(generation !== null) {
+                        dataGeneration = generation;
+                }
+        });
+})(jQuery);
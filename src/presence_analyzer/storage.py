@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+"""
+Memory bounded access to presence data.
+
+Presence data file is scanned once to find byte ranges of each user's rows,
+they're stored in sidecar index file next to it. Rows of a user are parsed
+when they are needed and the least recently used users are evicted when
+their estimated size exceeds the memory budget.
+"""
+
+import os
+import csv
+import sys
+import json
+import mmap
+from datetime import datetime, date, time
+from threading import Lock
+from collections import Mapping, OrderedDict
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=C0103
+
+# Estimated size of one day of presence data, including dict slot of the day.
+ENTRY_SIZE = (
+    sys.getsizeof({'start': None, 'end': None}) +
+    sys.getsizeof(date.today()) +
+    2 * sys.getsizeof(time()) +
+    24
+)
+
+# Presence bitmaps have a bit for each quarter of an hour of the day.
+BITMAP_SLOT = 15 * 60
+BITMAP_SLOTS = 24 * 60 * 60 // BITMAP_SLOT
+
+INDEXES = {}
+
+
+def parse_row(row):
+    """
+    Parses CSV row into (user_id, date, start, end) tuple.
+
+    Raises ValueError or TypeError for malformed rows.
+    """
+    user_id = int(row[0])
+    day = datetime.strptime(row[1], '%Y-%m-%d').date()
+    start = datetime.strptime(row[2], '%H:%M:%S').time()
+    end = datetime.strptime(row[3], '%H:%M:%S').time()
+    return user_id, day, start, end
+
+
+def day_bitmap(start, end):
+    """
+    Packs presence between start and end time into integer bitmap.
+
+    Bit N is set when user was present during any part of N-th quarter of
+    an hour of the day.
+    """
+    start = (start.hour * 60 + start.minute) * 60 + start.second
+    end = (end.hour * 60 + end.minute) * 60 + end.second
+    if end <= start:
+        return 0
+    first = start // BITMAP_SLOT
+    last = min(-(-end // BITMAP_SLOT), BITMAP_SLOTS)
+    return ((1 << last) - 1) ^ ((1 << first) - 1)
+
+
+def user_bitmaps(items):
+    """
+    Returns presence bitmaps of user's days, see day_bitmap().
+    """
+    return {
+        day: day_bitmap(item['start'], item['end'])
+        for day, item in items.items()
+    }
+
+
+def user_aggregate(items):
+    """
+    Sums presence of user's days by weekday.
+
+    Returns [days, total presence, sum of start times, sum of end times]
+    list of each weekday, times are in seconds since midnight.
+    """
+    result = [[0, 0, 0, 0] for weekday in range(7)]
+    for day, item in items.items():
+        start, end = item['start'], item['end']
+        start = (start.hour * 60 + start.minute) * 60 + start.second
+        end = (end.hour * 60 + end.minute) * 60 + end.second
+        weekday = result[day.weekday()]
+        weekday[0] += 1
+        weekday[1] += end - start
+        weekday[2] += start
+        weekday[3] += end
+    return result
+
+
+class PresenceData(dict):
+    """
+    Presence data grouped by user_id with anomalies found while parsing.
+
+    Presence bitmaps of users' days are kept in 'bitmaps' attribute.
+    """
+    anomalies = None
+    bitmaps = None
+
+
+def parse_rows(lines, detector=None):
+    """
+    Parses CSV lines into presence data grouped by user_id.
+
+    Header, footer and malformed lines are skipped. Parsed days are passed
+    to 'detector' in date order, which needn't be the order of rows, its
+    anomalies are kept in returned data.
+    """
+    data = PresenceData()
+    data.bitmaps = {}
+    for i, row in enumerate(csv.reader(lines, delimiter=',')):
+        if len(row) != 4:
+            # ignore header and footer lines
+            continue
+        try:
+            user_id, day, start, end = parse_row(row)
+        except (ValueError, TypeError):
+            log.debug('Problem with line %d: ', i, exc_info=True)
+            continue
+        data.setdefault(user_id, {})[day] = {'start': start, 'end': end}
+        data.bitmaps.setdefault(user_id, {})[day] = day_bitmap(start, end)
+    if detector is not None:
+        for user_id, items in data.iteritems():
+            detector.add_user(user_id, items)
+        data.anomalies = detector.anomalies
+    return data
+
+
+def scan_ranges(path):
+    """
+    Finds byte ranges of rows of each user in CSV file.
+
+    Returns dict of [start, end) offset lists keyed by user_id, consecutive
+    rows of a user are merged into single range.
+    """
+    ranges = {}
+    offset = 0
+    previous = None
+    with open(path, 'rb') as csvfile:
+        for line in csvfile:
+            row = line.split(',', 1)
+            try:
+                user_id = int(row[0]) if len(row) == 2 else None
+            except ValueError:
+                user_id = None
+            if user_id is not None:
+                if user_id == previous:
+                    ranges[user_id][-1][1] = offset + len(line)
+                else:
+                    ranges.setdefault(user_id, []).append(
+                        [offset, offset + len(line)]
+                    )
+            previous = user_id
+            offset += len(line)
+    return ranges
+
+
+def source_signature(path):
+    """
+    Identifies version of given file by its modification time and size.
+    """
+    stat = os.stat(path)
+    return [stat.st_mtime, stat.st_size]
+
+
+def aggregate_users(path, ranges):
+    """
+    Reads users one by one, returns their weekday aggregates keyed by
+    user_id, see user_aggregate().
+    """
+    return {
+        user_id: user_aggregate(
+            parse_rows(read_ranges(path, user_ranges)).get(user_id, {})
+        )
+        for user_id, user_ranges in ranges.items()
+    }
+
+
+def load_index(path):
+    """
+    Returns index of CSV file, dict with 'source' signature of the file,
+    byte 'ranges' of users' rows, see scan_ranges(), and weekday
+    'aggregates' of users, see aggregate_users().
+
+    Index is stored in sidecar '.idx' file, which is rebuilt when CSV file
+    changes.
+    """
+    signature = source_signature(path)
+    cached = INDEXES.get(path)
+    if cached is not None and cached['source'] == signature:
+        return cached
+
+    index_path = path + '.idx'
+    index = None
+    try:
+        with open(index_path, 'rb') as indexfile:
+            stored = json.load(indexfile)
+        if stored['source'] == signature:
+            index = {
+                'source': signature,
+                'ranges': {
+                    int(user_id): user_ranges
+                    for user_id, user_ranges in stored['ranges'].items()
+                },
+                'aggregates': {
+                    int(user_id): aggregate
+                    for user_id, aggregate in stored['aggregates'].items()
+                },
+            }
+    except (IOError, ValueError, KeyError):
+        log.debug('Index %s is missing or broken', index_path)
+
+    if index is None:
+        ranges = scan_ranges(path)
+        index = {
+            'source': signature,
+            'ranges': ranges,
+            'aggregates': aggregate_users(path, ranges),
+        }
+        try:
+            with open(index_path + '.tmp', 'wb') as indexfile:
+                json.dump(index, indexfile, separators=(',', ':'))
+            os.rename(index_path + '.tmp', index_path)
+        except (IOError, OSError):
+            log.warning('Could not write index %s', index_path, exc_info=True)
+
+    INDEXES[path] = index
+    return index
+
+
+def read_ranges(path, ranges):
+    """
+    Reads CSV lines found in given byte ranges.
+
+    File is memory mapped, so only pages holding the ranges are read.
+    """
+    if not ranges:
+        return []
+    lines = []
+    with open(path, 'rb') as csvfile:
+        mapped = mmap.mmap(csvfile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for start, end in ranges:
+                lines.extend(mapped[start:end].splitlines(True))
+        finally:
+            mapped.close()
+    return lines
+
+
+def read_user(path, user_id):
+    """
+    Reads presence data of single user using index, None if there's none.
+    """
+    ranges = load_index(path)['ranges'].get(user_id)
+    if ranges is None:
+        return None
+    return parse_rows(read_ranges(path, ranges)).get(user_id, {})
+
+
+class PresenceStore(Mapping):
+    """
+    Presence data grouped by user_id, read on demand within memory budget.
+
+    Behaves as read only dict of presence data. Rows of a user are read
+    from CSV file on first access and kept until the least recently used
+    users have to be evicted to stay within 'budget' bytes. Weekday
+    aggregates of all users are kept in 'aggregates' attribute, so
+    statistics don't need to read users. Store stays bound to the CSV file
+    version it indexed, see outdated().
+    """
+
+    def __init__(self, path, budget, index=None):
+        self.path = path
+        self.budget = budget
+        self.index = load_index(path) if index is None else index
+        self.ranges = self.index['ranges']
+        self.aggregates = self.index['aggregates']
+        self.resident = OrderedDict()
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = Lock()
+
+    def __getitem__(self, user_id):
+        with self.lock:
+            if user_id in self.resident:
+                self.hits += 1
+                items = self.resident.pop(user_id)
+                self.resident[user_id] = items
+                return items
+        if user_id not in self.ranges:
+            raise KeyError(user_id)
+
+        items = self.load(user_id)
+        with self.lock:
+            self.misses += 1
+            if user_id not in self.resident:
+                self.resident[user_id] = items
+                self.resident_bytes += len(items) * ENTRY_SIZE
+                self.evict()
+        return items
+
+    def __contains__(self, user_id):
+        return user_id in self.ranges
+
+    def __iter__(self):
+        return iter(self.ranges)
+
+    def __len__(self):
+        return len(self.ranges)
+
+    def __getstate__(self):
+        # resident users aren't shared, other process reads them again
+        return {
+            'path': self.path,
+            'budget': self.budget,
+            'index': self.index,
+        }
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['budget'], state['index'])
+
+    def outdated(self):
+        """
+        Tells whether CSV file changed since the store indexed it.
+
+        Users of outdated store are read through current index of the file,
+        until the store is replaced.
+        """
+        try:
+            return source_signature(self.path) != self.index['source']
+        except OSError:
+            return True
+
+    def load(self, user_id):
+        """
+        Reads presence data of given user from CSV file.
+        """
+        ranges = self.ranges
+        if self.outdated():
+            ranges = load_index(self.path)['ranges']
+        lines = read_ranges(self.path, ranges.get(user_id))
+        return parse_rows(lines).get(user_id, {})
+
+    def iter_users(self, user_ids=None):
+        """
+        Yields (user_id, items) pairs of all or given users, without keeping
+        them.
+        """
+        for user_id in self.ranges if user_ids is None else user_ids:
+            if user_id not in self.ranges:
+                continue
+            with self.lock:
+                items = self.resident.get(user_id)
+            yield user_id, items if items is not None else self.load(user_id)
+
+    def evict(self):
+        """
+        Evicts least recently used users until budget is met.
+
+        The most recently used user is always kept.
+        """
+        while self.resident_bytes > self.budget and len(self.resident) > 1:
+            user_id, items = self.resident.popitem(last=False)
+            self.resident_bytes -= len(items) * ENTRY_SIZE
+            self.evictions += 1
+
+    def stats(self):
+        """
+        Returns memory usage and eviction counters.
+        """
+        with self.lock:
+            return {
+                'budget': self.budget,
+                'users': len(self.ranges),
+                'resident_users': len(self.resident),
+                'resident_bytes': self.resident_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+def data_stats(data):
+    """
+    Returns memory usage of presence data, loaded fully or by the store.
+    """
+    if isinstance(data, PresenceStore):
+        return data.stats()
+    entries = sum(len(items) for items in data.values())
+    return {
+        'budget': None,
+        'users': len(data),
+        'resident_users': len(data),
+        'resident_bytes': entries * ENTRY_SIZE,
+        'hits': 0,
+        'misses': 0,
+        'evictions': 0,
+    }
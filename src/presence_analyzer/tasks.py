@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Background tasks refreshing data outside of request handling.
+"""
+
+from threading import Thread, Event
+
+from presence_analyzer import utils
+from presence_analyzer.utils import get_data, update_xml_data
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=C0103
+
+
+class PeriodicTask(Thread):
+    """
+    Daemon thread calling given function every 'interval' seconds.
+    """
+
+    def __init__(self, function, interval):
+        super(PeriodicTask, self).__init__(name=function.__name__)
+        self.daemon = True
+        self.function = function
+        self.interval = interval
+        self.stopped = Event()
+
+    def run(self):
+        """
+        Calls function until task is stopped, errors are only logged.
+        """
+        while not self.stopped.is_set():
+            try:
+                self.function()
+            except Exception:  # pylint: disable=W0703
+                log.exception('Task %s failed', self.name)
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        """
+        Stops calling function, current call is finished.
+        """
+        self.stopped.set()
+
+
+def fetch_xml():
+    """
+    Fetches users XML, failures are only logged.
+    """
+    try:
+        update_xml_data()
+    except IOError:
+        log.warning('Could not fetch users XML', exc_info=True)
+
+
+def refresh_data():
+    """
+    Loads presence data again.
+    """
+    get_data.refresh()
+
+
+def start_refresh(interval):
+    """
+    Starts refreshing data in background every 'interval' seconds.
+
+    Users XML is fetched in its own task, so a slow download doesn't delay
+    presence data. Presence data isn't reloaded periodically while data
+    files are watched, the watcher reloads it when it changes.
+    """
+    tasks = [PeriodicTask(fetch_xml, interval)]
+    if utils.WATCHER is None:
+        tasks.append(PeriodicTask(refresh_data, interval))
+    for task in tasks:
+        task.start()
+    return tasks
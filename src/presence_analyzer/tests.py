@@ -3,11 +3,36 @@
 Presence analyzer unit tests.
 """
 import os.path
+import gc
+import sys
 import json
+import time
+import signal
+import socket
+import urllib2
+import shutil
 import datetime
+import weakref
+import tempfile
 import unittest
+import subprocess
+from threading import Event, Thread
 
-from presence_analyzer import main, utils
+from presence_analyzer import (
+    main,
+    utils,
+    tasks,
+    storage,
+    watch,
+    anomalies,
+    backends,
+    prefork,
+    benchmark,
+    asyncserver,
+)
+from presence_analyzer import views  # pylint: disable=W0611
+
+STARTUP_TIME_BUDGET = 0.5
 
 
 TEST_DATA_CSV = os.path.join(
@@ -78,6 +103,18 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
                       '<a href="/presence_start_end.html">',
                       resp.data)
 
+    def test_presence_heatmap_page(self):
+        """
+        Test presence heatmap page.
+        """
+        resp = self.client.get('/presence_heatmap.html')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'text/html; charset=utf-8')
+        self.assertIn('/api/v1/presence_heatmap/', resp.data)
+        self.assertIn('<li id="selected">\n                    '
+                      '<a href="/presence_heatmap.html">',
+                      resp.data)
+
     def test_presence_weekday_page(self):
         """
         Test presence weekday page.
@@ -145,6 +182,208 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         ]
         self.assertEqual(data, sample_data)
 
+    def test_api_groups(self):
+        """
+        Test groups listing.
+        """
+        resp = self.client.get('/api/v1/groups')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual(data, [{u'name': u'Python', u'user_ids': [141, 176]}])
+
+    def test_api_group_mean_time_weekday(self):
+        """
+        Test mean time of group members grouped by weekday.
+        """
+        resp = self.client.get('/api/v1/mean_time_weekday/group/Java')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data), [])
+
+        main.app.config.update({'GROUPS': {'Office': [10, 11]}})
+        utils.DIRECTORY = {}
+        resp = self.client.get('/api/v1/mean_time_weekday/group/Office')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 7)
+        self.assertEqual(data[1], [u'Tue', 23305.5])
+        del main.app.config['GROUPS']
+        utils.DIRECTORY = {}
+
+    def test_api_occupancy(self):
+        """
+        Test number of present users in each 15 minutes of a day.
+        """
+        resp = self.client.get(
+            '/api/v1/occupancy?from=2013-09-10&to=2013-09-10'
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 96)
+        self.assertEqual(data[38], [u'09:30', 2])
+
+        resp = self.client.get('/api/v1/occupancy?weekday=1')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(data[38], [u'09:30', 2])
+
+        resp = self.client.get('/api/v1/occupancy?from=yesterday')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get('/api/v1/occupancy?weekday=7')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_api_memory(self):
+        """
+        Test memory usage of presence data.
+        """
+        resp = self.client.get('/api/v1/memory')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual(data['users'], 2)
+        self.assertEqual(data['evictions'], 0)
+
+    def test_api_data_generation(self):
+        """
+        Test pinning generation of presence data.
+        """
+        utils.clear_cache()
+        resp = self.client.get('/api/v1/presence_weekday/10')
+        generation = int(resp.headers['X-Data-Generation'])
+        old_data = resp.data
+        self.assertEqual(utils.CACHE, {})
+        self.assertEqual(utils.get_generation()[0], generation)
+        resp = self.client.get('/api/v1/presence_weekday/10')
+        self.assertEqual(int(resp.headers['X-Data-Generation']), generation)
+        self.assertEqual(resp.data, old_data)
+
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV_CACHE})
+        utils.get_data.refresh()
+        resp = self.client.get('/api/v1/presence_weekday/10')
+        self.assertEqual(
+            int(resp.headers['X-Data-Generation']),
+            generation + 1
+        )
+        self.assertEqual(json.loads(resp.data), [])
+
+        headers = {'X-Data-Generation': str(generation)}
+        resp = self.client.get('/api/v1/presence_weekday/10', headers=headers)
+        self.assertEqual(int(resp.headers['X-Data-Generation']), generation)
+        self.assertEqual(resp.data, old_data)
+
+        resp = self.client.get('/api/v1/users', headers=headers)
+        self.assertEqual(int(resp.headers['X-Data-Generation']), generation)
+        self.assertEqual(len(json.loads(resp.data)), 2)
+
+        utils.SNAPSHOTS[generation]['retired'] = datetime.datetime(2000, 1, 1)
+        resp = self.client.get('/api/v1/presence_weekday/10', headers=headers)
+        self.assertEqual(
+            int(resp.headers['X-Data-Generation']),
+            generation + 1
+        )
+        utils.clear_cache()
+
+    def test_api_precomputed_generation(self):
+        """
+        Test precomputed statistics are used only for their generation.
+        """
+        path = os.path.join(tempfile.mkdtemp(), 'statistics.json.gz')
+        main.app.config.update({'DATA_STATS': path})
+        utils.clear_cache()
+        utils.dump_statistics(path, processes=1)
+        resp = self.client.get('/api/v1/presence_weekday/10')
+        generation = int(resp.headers['X-Data-Generation'])
+        self.assertEqual(json.loads(resp.data)[2], ['Tue', 30047])
+
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV_CACHE})
+        utils.get_data.refresh()
+        resp = self.client.get('/api/v1/presence_weekday/10')
+        self.assertEqual(
+            int(resp.headers['X-Data-Generation']),
+            generation + 1
+        )
+        self.assertEqual(json.loads(resp.data), [])
+
+        headers = {'X-Data-Generation': str(generation)}
+        resp = self.client.get('/api/v1/presence_weekday/10', headers=headers)
+        self.assertEqual(int(resp.headers['X-Data-Generation']), generation)
+        self.assertEqual(json.loads(resp.data)[2], ['Tue', 30047])
+
+        del main.app.config['DATA_STATS']
+        shutil.rmtree(os.path.dirname(path))
+        utils.clear_cache()
+
+    def test_api_export_statistics(self):
+        """
+        Test streaming statistics of users.
+        """
+        resp = self.client.get('/api/v1/export/statistics.csv?user_id=10')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'text/csv; charset=utf-8')
+        self.assertIn('X-Data-Generation', resp.headers)
+        lines = resp.data.splitlines()
+        self.assertEqual(len(lines), 8)
+        self.assertEqual(lines[0], 'user_id,weekday,days,total,mean,start,end')
+        self.assertEqual(lines[2], '10,Tue,1,30047,30047.0,34745.0,64792.0')
+
+        resp = self.client.get('/api/v1/export/statistics.ndjson')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/x-ndjson')
+        lines = resp.data.splitlines()
+        self.assertEqual(len(lines), 14)
+        self.assertEqual(json.loads(lines[1])['total'], 30047)
+
+        resp = self.client.get('/api/v1/export/statistics.xls')
+        self.assertEqual(resp.status_code, 404)
+        resp = self.client.get('/api/v1/export/statistics.csv?user_id=abc')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get('/api/v1/export/statistics.csv?user_id=5')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(resp.data.splitlines()), 1)
+
+    def test_api_export_presence(self):
+        """
+        Test streaming raw presence rows.
+        """
+        resp = self.client.get('/api/v1/export/presence.csv')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'text/csv; charset=utf-8')
+        lines = resp.data.splitlines()
+        self.assertEqual(len(lines), 10)
+        self.assertEqual(lines[1], '10,2013-09-10,09:39:05,17:59:52')
+
+        resp = self.client.get(
+            '/api/v1/export/presence.ndjson'
+            '?user_id=11&user_id=5&from=2013-09-10&to=2013-09-11'
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            [json.loads(line) for line in resp.data.splitlines()],
+            [
+                {
+                    u'user_id': 11,
+                    u'date': u'2013-09-10',
+                    u'start': u'09:19:50',
+                    u'end': u'13:55:54',
+                },
+                {
+                    u'user_id': 11,
+                    u'date': u'2013-09-11',
+                    u'start': u'09:13:26',
+                    u'end': u'16:15:27',
+                },
+            ]
+        )
+
+        resp = self.client.get('/api/v1/export/presence.csv?from=today')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get(
+            '/api/v1/export/presence.csv?user_id=10&user_id='
+        )
+        self.assertEqual(resp.status_code, 400)
+
     def test_api_mean_time_weekday(self):
         """
         Test mean user time grouped by weekday.
@@ -198,6 +437,35 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         ]
         self.assertEqual(data, correct_data)
 
+    def test_api_presence_heatmap(self):
+        """
+        Test probability of presence in each hour grouped by weekday.
+        """
+        utils.clear_cache()
+        resp = self.client.get('/api/v1/presence_heatmap/5')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual(data, [])
+        resp = self.client.get('/api/v1/presence_heatmap/10')
+        self.assertEqual(utils.CACHE, {})
+        utils.get_data()
+        self.assertEqual(
+            json.loads(resp.data),
+            json.loads(json.dumps(utils.get_user_heatmap(10)))
+        )
+
+        resp = self.client.get('/api/v1/presence_heatmap/10')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual([weekday for weekday, hours in data], [
+            u'Mon', u'Tue', u'Wed', u'Thu', u'Fri', u'Sat', u'Sun',
+        ])
+        self.assertEqual(data[0][1], [0] * 24)
+        self.assertEqual(data[1][1][8:18], [0, 0.5] + [1] * 8)
+        self.assertEqual(data[1][1][18:], [0] * 6)
+
     def test_api_presence_start_end(self):
         """
         Test time intervals when user is most often present grouped by weekday.
@@ -275,6 +543,90 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
         utils.CACHE = {}
 
+    def test_refresh_waits_for_load(self):
+        """
+        Test refreshing data while it's being loaded by another thread.
+        """
+        calls = []
+        started = Event()
+        release = Event()
+
+        @utils.cache(600)
+        def function():
+            """
+            Returns old content on first call, waits to be released.
+            """
+            calls.append(None)
+            if len(calls) == 1:
+                started.set()
+                release.wait(1)
+                return 'old'
+            return 'new'
+
+        utils.CACHE = {}
+        loader = Thread(target=function)
+        loader.start()
+        self.assertTrue(started.wait(1))
+        refresher = Thread(target=function.refresh)
+        refresher.start()
+        time.sleep(0.05)
+        self.assertEqual(len(calls), 1)
+
+        release.set()
+        loader.join(1)
+        refresher.join(1)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(function(), 'new')
+        utils.clear_cache()
+
+    def test_clear_cache(self):
+        """
+        Test dropping cached data.
+        """
+        utils.get_data()
+        self.assertIn('data', utils.CACHE)
+        utils.clear_cache()
+        self.assertEqual(utils.CACHE, {})
+
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV_CACHE})
+        data = utils.get_data()
+        self.assertItemsEqual(data.keys(), [62, 63])
+
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        utils.clear_cache()
+
+    def test_get_data_refresh(self):
+        """
+        Test recomputing cached data.
+        """
+        utils.get_data()
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV_CACHE})
+        self.assertItemsEqual(utils.get_data().keys(), [10, 11])
+
+        data = utils.get_data.refresh()
+        self.assertItemsEqual(data.keys(), [62, 63])
+        self.assertIs(utils.get_data(), data)
+
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        utils.clear_cache()
+
+    def test_update_xml_data(self):
+        """
+        Test replacing local XML file with downloaded one.
+        """
+        path = os.path.join(tempfile.mkdtemp(), 'users.xml')
+        main.app.config.update({
+            'DATA_XML': path,
+            'DATA_XML_URL': 'file://' + os.path.abspath(TEST_DATA_XML),
+        })
+        utils.update_xml_data()
+        with open(path) as xmlfile, open(TEST_DATA_XML) as test_xmlfile:
+            self.assertEqual(xmlfile.read(), test_xmlfile.read())
+        self.assertFalse(os.path.exists(path + '.tmp'))
+
+        del main.app.config['DATA_XML_URL']
+        shutil.rmtree(os.path.dirname(path))
+
     def test_get_xml_data(self):
         """
         Test parsing XML file.
@@ -286,6 +638,245 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         sample_name = 'Adam P.'
         self.assertEqual(sample_name, data[0]['name'])
 
+    def test_collation_keys(self):
+        """
+        Test sorting names.
+        """
+        names = [u'Zenon', u'Adam', u'Bartek']
+        keys = utils.collation_keys(names)
+        self.assertEqual(
+            [name for key, name in sorted(zip(keys, names))],
+            [u'Adam', u'Bartek', u'Zenon']
+        )
+
+    def test_build_user_directory(self):
+        """
+        Test joining users from XML with users having presence data.
+        """
+        xml_users = [
+            (141, u'Zbigniew T.', 'https://example.com/141', None),
+            (10, u'Adam P.', 'https://example.com/10', None),
+        ]
+        directory = utils.build_user_directory({10: {}, 11: {}}, xml_users)
+        self.assertEqual(directory.keys(), [10, 11, 141])
+        self.assertEqual(
+            directory[10],
+            (10, u'Adam P.', 'https://example.com/10', True)
+        )
+        self.assertEqual(directory[11], (11, u'User 11', None, True))
+        self.assertFalse(directory[141].present)
+
+        other = utils.build_user_directory({11: {}}, xml_users)
+        self.assertIs(other[11].name, directory[11].name)
+        self.assertIs(other[10].avatar, directory[10].avatar)
+
+    def test_get_user_directory(self):
+        """
+        Test rebuilding user directory only when data changes.
+        """
+        directory = utils.get_user_directory()
+        self.assertEqual(directory['directory'].keys(), [141, 176, 10, 11])
+        self.assertEqual(
+            directory['users'],
+            [
+                {'user_id': 10, 'name': 'User 10'},
+                {'user_id': 11, 'name': 'User 11'},
+            ]
+        )
+        self.assertEqual(directory['xml_users'], utils.get_xml_data())
+        self.assertEqual(directory['groups'], {'Python': (141, 176)})
+        self.assertIs(utils.get_user_directory(), directory)
+
+        utils.get_data.refresh()
+        self.assertIsNot(utils.get_user_directory(), directory)
+
+    def test_build_groups(self):
+        """
+        Test grouping users by XML attribute and GROUPS setting.
+        """
+        xml_users = [
+            (141, u'Zbigniew T.', 'https://example.com/141', 'Python'),
+            (10, u'Adam P.', 'https://example.com/10', None),
+            (11, u'Adam K.', 'https://example.com/11', 'Python'),
+        ]
+        main.app.config.update({'GROUPS': {'Office': [10, 11]}})
+        self.assertEqual(
+            utils.build_groups(xml_users),
+            {'Python': (11, 141), 'Office': (10, 11)}
+        )
+        del main.app.config['GROUPS']
+
+    def test_retain_snapshot(self):
+        """
+        Test keeping limited number of replaced generations.
+        """
+        utils.clear_cache()
+        generation = utils.get_generation()[0]
+        data = utils.get_data()
+        utils.get_data.refresh()
+        self.assertIs(utils.get_snapshot(generation)['data'], data)
+        self.assertIsNone(utils.get_snapshot(generation + 1))
+
+        utils.get_data.refresh()
+        utils.get_data.refresh()
+        self.assertEqual(
+            utils.SNAPSHOTS.keys(),
+            [generation + 1, generation + 2]
+        )
+        self.assertIsNone(utils.get_snapshot(generation))
+
+        main.app.config.update({'SNAPSHOT_TTL': 0})
+        self.assertIsNone(utils.get_snapshot(generation + 2))
+        del main.app.config['SNAPSHOT_TTL']
+        utils.clear_cache()
+        self.assertEqual(utils.SNAPSHOTS, {})
+
+    def test_per_generation_limit(self):
+        """
+        Test keeping limited number of least recently used results.
+        """
+        calls = []
+
+        @utils.per_generation(limit=2)
+        def users(data, limit):
+            """
+            Returns sorted user ids.
+            """
+            calls.append(limit)
+            return sorted(data)[:limit]
+
+        self.assertEqual(users(1), [10])
+        self.assertEqual(users(2), [10, 11])
+        self.assertEqual(users(1), [10])
+        self.assertEqual(users(0), [])
+        self.assertEqual(users(1), [10])
+        self.assertEqual(calls, [1, 2, 0])
+        self.assertEqual(users(2), [10, 11])
+        self.assertEqual(calls, [1, 2, 0, 2])
+
+    def test_expired_snapshot_released(self):
+        """
+        Test expired snapshots and results computed from them are released.
+        """
+        utils.clear_cache()
+        data = weakref.ref(utils.get_data())
+        utils.get_anomalies()
+        utils.get_user_directory()
+        utils.get_data.refresh()
+        self.assertIsNotNone(data())
+
+        main.app.config.update({'SNAPSHOT_TTL': 0})
+        utils.get_anomalies()
+        utils.get_user_directory()
+        self.assertEqual(utils.SNAPSHOTS, {})
+        gc.collect()
+        self.assertIsNone(data())
+        del main.app.config['SNAPSHOT_TTL']
+        utils.clear_cache()
+
+    def test_export_chunks(self):
+        """
+        Test formatting rows in chunks.
+        """
+        rows = [('id', 'name')] + [(i, 'x' * 100) for i in range(1000)]
+        chunks = list(utils.csv_chunks(rows))
+        self.assertEqual(len(chunks), 2)
+        self.assertEqual(''.join(chunks).count('\n'), 1001)
+
+        chunks = list(utils.ndjson_chunks(rows))
+        self.assertEqual(len(chunks), 2)
+        self.assertEqual(
+            json.loads(''.join(chunks).splitlines()[5]),
+            {u'id': 5, u'name': u'x' * 100}
+        )
+        self.assertEqual(list(utils.ndjson_chunks([('id',)])), [])
+
+    def test_per_generation(self):
+        """
+        Test caching results until data is reloaded.
+        """
+        calls = []
+
+        @utils.per_generation
+        def function(data, argument):
+            """
+            Records calls.
+            """
+            calls.append(argument)
+            return len(data)
+
+        self.assertEqual(function(1), 2)
+        self.assertEqual(function(1), 2)
+        self.assertEqual(function(2), 2)
+        self.assertEqual(calls, [1, 2])
+        utils.get_data.refresh()
+        self.assertEqual(function(1), 2)
+        self.assertEqual(calls, [1, 2, 1])
+
+    def test_aggregates(self):
+        """
+        Test calculating and merging weekday aggregates.
+        """
+        aggregates = utils.get_user_aggregates()
+        self.assertItemsEqual(aggregates.keys(), [10, 11])
+        self.assertEqual(aggregates[10][:3], [[0, 0], [1, 30047], [1, 24465]])
+        merged = utils.merge_aggregates([aggregates[10], aggregates[10]])
+        self.assertEqual(merged[:3], [[0, 0], [2, 60094], [2, 48930]])
+        self.assertIs(utils.get_user_aggregates(), aggregates)
+
+        self.assertEqual(
+            utils.group_mean_time_weekday((10, 141)),
+            utils.mean_time_weekday(utils.get_data()[10])
+        )
+        result = utils.group_mean_time_weekday((10, 11))
+        self.assertEqual(result[1], ('Tue', 23305.5))
+
+    def test_presence_heatmap(self):
+        """
+        Test counting quarters of an hour present in bitmaps.
+        """
+        result = utils.presence_heatmap({
+            datetime.date(2013, 9, 10): 0b1111 << 36,
+            datetime.date(2013, 9, 17): 0b0011 << 36 | 0b1000 << 40,
+        })
+        self.assertEqual(len(result), 7)
+        self.assertEqual(result[0], ('Mon', [0] * 24))
+        self.assertEqual(result[1][0], 'Tue')
+        self.assertEqual(result[1][1][9:11], [0.75, 0.13])
+        self.assertEqual(result[1][1].count(0), 22)
+
+    def test_occupancy(self):
+        """
+        Test counting present users in time slots.
+        """
+        result = utils.occupancy(datetime.date.min, datetime.date.max)
+        self.assertEqual(len(result), 96)
+        self.assertEqual(result[0], ('00:00', 0))
+        self.assertEqual(result[38][0], '09:30')
+
+        day = datetime.date(2013, 9, 10)
+        result = dict(utils.occupancy(day, day))
+        self.assertEqual(result['09:00'], 0)
+        self.assertEqual(result['09:15'], 1)
+        self.assertEqual(result['09:30'], 2)
+        self.assertEqual(result['14:00'], 1)
+        self.assertEqual(result['17:45'], 1)
+        self.assertEqual(result['18:00'], 0)
+
+        result = dict(utils.occupancy(
+            datetime.date.min,
+            datetime.date.max,
+            0
+        ))
+        self.assertEqual(result['08:45'], 0)
+        self.assertEqual(result['09:00'], 1)
+
+        result = dict(utils.occupancy(
+            datetime.date(2013, 9, 1),
+            datetime.date(2013, 9, 2)
+        ))
+        self.assertEqual(result['12:00'], 0)
+
     def test_seconds_since_midnight(self):
         """
         Test seconds since midnight.
@@ -354,6 +945,1243 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         }
         self.assertDictEqual(result, data)
 
+    def test_statistics(self):
+        """
+        Test statistics calculated from presence entries.
+        """
+        items = utils.get_data()[10]
+        self.assertEqual(
+            utils.mean_time_weekday(items)[1:3],
+            [('Tue', 30047), ('Wed', 24465)]
+        )
+        self.assertEqual(
+            utils.presence_weekday(items)[:3],
+            [('Weekday', 'Presence (s)'), ('Mon', 0), ('Tue', 30047)]
+        )
+        self.assertEqual(
+            utils.presence_start_end(items)[:2],
+            [('Mon', 0, 0), ('Tue', 34745, 64792)]
+        )
+        user_id, statistics = utils.user_statistics((10, items))
+        self.assertEqual(user_id, 10)
+        self.assertItemsEqual(statistics.keys(), utils.STATISTICS.keys())
+
+    def test_dump_statistics(self):
+        """
+        Test precomputing statistics of all users.
+        """
+        self.assertIsNone(utils.get_statistics())
+
+        path = os.path.join(tempfile.mkdtemp(), 'statistics.json.gz')
+        main.app.config.update({'DATA_STATS': path})
+        users = utils.dump_statistics(path, processes=2)
+        self.assertItemsEqual(users.keys(), [10, 11])
+
+        statistics = utils.get_statistics()
+        self.assertItemsEqual(statistics.keys(), [10, 11])
+        self.assertEqual(
+            statistics[10]['presence_start_end'][1],
+            ['Tue', 34745, 64792]
+        )
+        self.assertEqual(
+            utils.get_user_statistic('presence_weekday', 10)[2],
+            ['Tue', 30047]
+        )
+        self.assertIsNone(utils.get_user_statistic('presence_weekday', 5))
+
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV_CACHE})
+        self.assertIsNone(utils.get_statistics())
+
+        # statistics of loaded data are recorded with its version
+        utils.dump_statistics(path, processes=1)
+        self.assertIsNone(utils.get_statistics())
+        self.assertEqual(
+            utils.get_statistics(utils.CACHE['version'][0]),
+            statistics
+        )
+
+        del main.app.config['DATA_STATS']
+        shutil.rmtree(os.path.dirname(path))
+
+
+class PresenceAnalyzerStorageTestCase(unittest.TestCase):
+    """
+    Memory bounded storage tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        main.app.config.update({'DATA_XML': TEST_DATA_XML})
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.config.pop('MEMORY_BUDGET', None)
+        utils.clear_cache()
+
+    def test_parse_rows(self):
+        """
+        Test parsing CSV lines, malformed ones are skipped.
+        """
+        data = storage.parse_rows([
+            'user_id,date,start,end\n',
+            '10,2013-09-10,09:39:05,17:59:52\n',
+            '10,2013-09-11,09:19:52\n',
+            '11,2013-09-3x,09:19:52,16:07:37\n',
+        ])
+        self.assertEqual(data, {
+            10: {
+                datetime.date(2013, 9, 10): {
+                    'start': datetime.time(9, 39, 5),
+                    'end': datetime.time(17, 59, 52),
+                },
+            },
+        })
+
+    def test_day_bitmap(self):
+        """
+        Test packing presence into quarters of an hour.
+        """
+        time = datetime.time
+        self.assertEqual(storage.day_bitmap(time(0, 0), time(0, 15)), 1)
+        self.assertEqual(
+            storage.day_bitmap(time(0, 14, 59), time(0, 15, 1)),
+            0b11
+        )
+        self.assertEqual(storage.day_bitmap(time(9, 0), time(8, 0)), 0)
+        self.assertEqual(
+            storage.day_bitmap(time(23, 50), time(23, 59, 59)),
+            1 << 95
+        )
+        self.assertEqual(
+            storage.day_bitmap(time(0, 0), time(23, 59, 59)),
+            (1 << 96) - 1
+        )
+
+        data = storage.parse_rows(['10,2013-09-10,09:39:05,17:59:52\n'])
+        bitmap = data.bitmaps[10][datetime.date(2013, 9, 10)]
+        self.assertEqual(bitmap, ((1 << 72) - 1) ^ ((1 << 38) - 1))
+
+    def test_scan_ranges(self):
+        """
+        Test finding byte ranges of users' rows.
+        """
+        ranges = storage.scan_ranges(TEST_DATA_CSV)
+        self.assertEqual(ranges, {10: [[0, 99]], 11: [[99, 295]]})
+        lines = storage.read_ranges(TEST_DATA_CSV, ranges[10])
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[0], '10,2013-09-10,09:39:05,17:59:52\r\n')
+
+    def test_load_index(self):
+        """
+        Test storing byte ranges in sidecar index file.
+        """
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+
+        index = storage.load_index(path)
+        self.assertEqual(index['ranges'], {10: [[0, 99]], 11: [[99, 295]]})
+        self.assertEqual(index['source'], storage.source_signature(path))
+        with open(path + '.idx') as indexfile:
+            self.assertEqual(
+                json.load(indexfile)['source'],
+                storage.source_signature(path)
+            )
+
+        storage.INDEXES.clear()
+        self.assertEqual(storage.load_index(path), index)
+
+        with open(path, 'a') as csvfile:
+            csvfile.write('\r\n12,2013-09-13,13:16:56,15:04:02')
+        os.utime(path, (0, 0))
+        ranges = storage.load_index(path)['ranges']
+        self.assertEqual(ranges[12], [[297, 328]])
+        self.assertEqual(
+            storage.read_user(path, 12).keys(),
+            [datetime.date(2013, 9, 13)]
+        )
+        self.assertIsNone(storage.read_user(path, 5))
+
+        storage.INDEXES.clear()
+        shutil.rmtree(directory)
+
+    def test_get_user_data(self):
+        """
+        Test reading single user's data served to the request.
+        """
+        utils.clear_cache()
+        data = utils.get_user_data(10)
+        self.assertEqual(utils.CACHE, {})
+        self.assertIsNone(utils.get_user_data(5))
+        generation = utils.reserve_generation(utils.data_version())
+        self.assertEqual(data, utils.get_data()[10])
+        self.assertEqual(utils.get_generation()[0], generation)
+        self.assertIs(utils.get_user_data(10), utils.get_data()[10])
+
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV_CACHE})
+        utils.clear_cache()
+        utils.get_user_data(10)
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        self.assertEqual(utils.get_generation()[0], generation + 2)
+
+    def test_presence_store(self):
+        """
+        Test reading users' data on demand within memory budget.
+        """
+        store = storage.PresenceStore(
+            TEST_DATA_CSV,
+            4 * storage.ENTRY_SIZE
+        )
+        self.assertItemsEqual(store.keys(), [10, 11])
+        self.assertIn(10, store)
+        self.assertNotIn(5, store)
+        self.assertRaises(KeyError, lambda: store[5])
+
+        data = utils.get_data()
+        self.assertEqual(store[10], data[10])
+        self.assertEqual(store[10], data[10])
+        self.assertEqual(store.stats(), {
+            'budget': 4 * storage.ENTRY_SIZE,
+            'users': 2,
+            'resident_users': 1,
+            'resident_bytes': 3 * storage.ENTRY_SIZE,
+            'hits': 1,
+            'misses': 1,
+            'evictions': 0,
+        })
+
+        self.assertEqual(store[11], data[11])
+        stats = store.stats()
+        self.assertEqual(stats['resident_users'], 1)
+        self.assertEqual(stats['resident_bytes'], 6 * storage.ENTRY_SIZE)
+        self.assertEqual(stats['evictions'], 1)
+
+    def test_store_aggregates(self):
+        """
+        Test statistics from weekday aggregates kept by the store.
+        """
+        store = storage.PresenceStore(TEST_DATA_CSV, 0)
+        data = utils.get_data()
+        self.assertItemsEqual(store.aggregates.keys(), [10, 11])
+        self.assertEqual(
+            store.aggregates[10],
+            storage.user_aggregate(data[10])
+        )
+        self.assertEqual(store.aggregates[10][1], [1, 30047, 34745, 64792])
+        for user_id in (10, 11):
+            statistics = utils.aggregate_statistics(store.aggregates[user_id])
+            for name, function in utils.STATISTICS.items():
+                self.assertEqual(statistics[name], function(data[user_id]))
+
+        rows = list(utils.statistics_rows(data))
+        self.assertEqual(list(utils.statistics_rows(store)), rows)
+        self.assertEqual(store.stats()['misses'], 0)
+
+    def test_scans_keep_resident_users(self):
+        """
+        Test full scans of the store don't evict recently used users.
+        """
+        main.app.config.update({'MEMORY_BUDGET': 4 * storage.ENTRY_SIZE})
+        store = utils.get_data()
+        self.assertEqual(len(store[10]), 3)
+
+        rows = list(utils.statistics_rows(store))
+        self.assertEqual(len(rows), 15)
+        rows = list(utils.presence_rows(store, [11, 10, 5]))
+        self.assertEqual([row[0] for row in rows[1:3]], [10, 10])
+        self.assertEqual(len(rows), 10)
+        utils.occupancy(datetime.date.min, datetime.date.max)
+        utils.get_user_aggregates()
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'statistics.json.gz')
+        users = utils.dump_statistics(path, processes=1)
+        self.assertItemsEqual(users.keys(), [10, 11])
+        shutil.rmtree(directory)
+
+        stats = store.stats()
+        self.assertEqual(stats['resident_users'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['evictions'], 0)
+        self.assertEqual(
+            list(store.iter_users([5, 11]))[0],
+            (11, store.load(11))
+        )
+
+    def test_outdated_store(self):
+        """
+        Test replacing the store when its CSV file is rewritten.
+        """
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        main.app.config.update({
+            'DATA_CSV': path,
+            'MEMORY_BUDGET': 4 * storage.ENTRY_SIZE,
+        })
+        generation, store = utils.get_generation()
+        self.assertFalse(store.outdated())
+
+        with open(path, 'w') as csvfile:
+            csvfile.write(
+                '5,2013-09-13,13:16:56,15:04:02\n'
+                '10,2013-09-10,09:39:05,17:59:52\n'
+            )
+        os.utime(path, (0, 0))
+        self.assertTrue(store.outdated())
+        self.assertEqual(len(store.load(10)), 1)
+        self.assertEqual(utils.get_generation()[0], generation + 1)
+        data = utils.get_data()
+        self.assertIsNot(data, store)
+        self.assertItemsEqual(data.keys(), [5, 10])
+        self.assertEqual(len(data[5]), 1)
+
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        storage.INDEXES.pop(path)
+        shutil.rmtree(directory)
+
+    def test_get_data_memory_budget(self):
+        """
+        Test loading presence data within memory budget.
+        """
+        main.app.config.update({'MEMORY_BUDGET': 1024})
+        data = utils.get_data()
+        self.assertIsInstance(data, storage.PresenceStore)
+        self.assertEqual(
+            utils.get_user_statistic('presence_weekday', 10)[2],
+            ('Tue', 30047)
+        )
+        self.assertIsNone(utils.get_user_statistic('presence_weekday', 5))
+        self.assertEqual(utils.get_memory_stats()['misses'], 0)
+
+        main.app.config.pop('MEMORY_BUDGET')
+        utils.clear_cache()
+        stats = utils.get_memory_stats()
+        self.assertEqual(stats['budget'], None)
+        self.assertEqual(stats['resident_bytes'], 9 * storage.ENTRY_SIZE)
+
+
+class PresenceAnalyzerAnomaliesTestCase(unittest.TestCase):
+    """
+    Anomaly detection tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.directory = tempfile.mkdtemp()
+        path = os.path.join(self.directory, 'data.csv')
+        with open(path, 'w') as csvfile:
+            csvfile.write(
+                '10,2013-09-03,09:00:00,17:00:00\n'
+                '10,2013-09-10,09:01:00,17:10:00\n'
+                '10,2013-09-17,09:02:00,16:50:00\n'
+                '10,2013-09-24,09:01:30,17:05:00\n'
+                '10,2013-10-29,15:56:10,17:01:33\n'
+            )
+        main.app.config.update({'DATA_CSV': path})
+        main.app.config.update({'DATA_XML': TEST_DATA_XML})
+        main.app.config.update({'ANOMALY_MIN_SAMPLES': 3})
+        self.client = main.app.test_client()
+        utils.clear_cache()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.config.pop('ANOMALY_MIN_SAMPLES')
+        main.app.config.pop('MEMORY_BUDGET', None)
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        utils.clear_cache()
+        shutil.rmtree(self.directory)
+
+    def test_running_stats(self):
+        """
+        Test running mean and standard deviation.
+        """
+        stats = anomalies.RunningStats()
+        self.assertEqual(stats.deviation(), 0)
+        for value in [2, 4, 4, 4, 5, 5, 7, 9]:
+            stats.add(value)
+        self.assertEqual(stats.count, 8)
+        self.assertAlmostEqual(stats.mean, 5)
+        self.assertAlmostEqual(stats.deviation(), 2.13808993)
+
+    def test_anomaly_detector(self):
+        """
+        Test flagging times far from the norm of the weekday.
+        """
+        detector = anomalies.AnomalyDetector(threshold=3, min_samples=3)
+        start, end = datetime.time(9, 0, 0), datetime.time(17, 0, 0)
+        for day in range(3, 25, 7):
+            detector.add(10, datetime.date(2013, 9, day), start, end)
+            detector.add(10, datetime.date(2013, 9, day + 1), start,
+                         datetime.time(17, 0, day))
+        detector.add(11, datetime.date(2013, 10, 1), start, end)
+        self.assertEqual(detector.anomalies, [])
+
+        detector.add(10, datetime.date(2013, 10, 1), start, end)
+        detector.add(10, datetime.date(2013, 10, 2), start,
+                     datetime.time(23, 0, 0))
+        self.assertEqual(len(detector.anomalies), 1)
+        self.assertEqual(detector.anomalies[0]['date'], '2013-10-02')
+        self.assertEqual(detector.anomalies[0]['field'], 'end')
+        self.assertEqual(detector.anomalies[0]['value'], 82800)
+
+    def test_get_anomalies(self):
+        """
+        Test anomalies found while loading presence data.
+        """
+        data = utils.get_data()
+        self.assertEqual(len(data.anomalies), 1)
+        result = utils.get_anomalies()
+        self.assertEqual(result, data.anomalies)
+        self.assertEqual(result[0]['date'], '2013-10-29')
+        self.assertEqual(result[0]['field'], 'start')
+        self.assertEqual(utils.get_anomalies(11), [])
+
+        main.app.config.update({'MEMORY_BUDGET': 1024})
+        utils.clear_cache()
+        self.assertEqual(utils.get_anomalies(10), result)
+        self.assertIs(utils.get_anomalies(), utils.get_anomalies())
+
+    def test_anomalies_date_order(self):
+        """
+        Test days are checked in date order, not in order of rows.
+        """
+        with open(main.app.config['DATA_CSV']) as csvfile:
+            lines = csvfile.readlines()
+        with open(main.app.config['DATA_CSV'], 'w') as csvfile:
+            csvfile.writelines(lines[::-1])
+        self.assertEqual(
+            [(item['date'], item['field']) for item in utils.get_anomalies()],
+            [('2013-10-29', 'start')]
+        )
+
+    def test_api_anomalies(self):
+        """
+        Test paging through anomalies.
+        """
+        resp = self.client.get('/api/v1/anomalies')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual(data['total'], 1)
+        self.assertEqual(data['page'], 1)
+        self.assertEqual(data['anomalies'][0]['user_id'], 10)
+
+        resp = self.client.get('/api/v1/anomalies?user_id=10&page=2')
+        data = json.loads(resp.data)
+        self.assertEqual(data['total'], 1)
+        self.assertEqual(data['anomalies'], [])
+
+        resp = self.client.get('/api/v1/anomalies?per_page=0')
+        self.assertEqual(resp.status_code, 400)
+
+
+class FakeRedis(object):
+    """
+    Stand-in for Redis client, keeping values in a dict.
+    """
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, name):
+        """
+        Returns value of the name.
+        """
+        return self.values.get(name)
+
+    def set(self, name, value, ex=None, nx=False):  # pylint: disable=W0613
+        """
+        Stores value of the name, only a new one with 'nx'.
+        """
+        if nx and name in self.values:
+            return None
+        self.values[name] = str(value)
+        return True
+
+    def incr(self, name):
+        """
+        Increments counter of the name.
+        """
+        self.values[name] = str(int(self.values.get(name, 0)) + 1)
+        return int(self.values[name])
+
+    def delete(self, name):
+        """
+        Removes the name.
+        """
+        self.values.pop(name, None)
+
+
+class PresenceAnalyzerBackendsTestCase(unittest.TestCase):
+    """
+    Cache backends tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.directory = tempfile.mkdtemp()
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV,
+            'CACHE_BACKEND': 'file://' + self.directory,
+        })
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV,
+            'CACHE_BACKEND': None,
+            'MEMORY_BUDGET': None,
+        })
+        utils.BACKENDS.clear()
+        utils.clear_cache()
+        shutil.rmtree(self.directory)
+
+    def assert_backend_works(self, backend):
+        """
+        Checks storing values, counters and locks of given backend.
+        """
+        self.assertIsNone(backend.get('key'))
+        backend.set('key', {'value': [1, 2]})
+        self.assertEqual(backend.get('key'), {'value': [1, 2]})
+        backend.set('key', (None,))
+        self.assertEqual(backend.get('key'), (None,))
+        self.assertEqual(backend.incr('counter'), 1)
+        self.assertEqual(backend.incr('counter'), 2)
+        with backend.lock('key'):
+            backend.set('locked', True)
+        self.assertTrue(backend.get('locked'))
+
+    def test_memory_backend(self):
+        """
+        Test keeping values in the process.
+        """
+        backend = backends.MemoryBackend()
+        self.assert_backend_works(backend)
+        backend.set('expired', 1, timeout=-1)
+        self.assertIsNone(backend.get('expired'))
+        self.assertNotIn('expired', backend.values)
+        backend.set('swept', 1, timeout=-1)
+        backend.swept = 0
+        backend.set('other', 1)
+        self.assertNotIn('swept', backend.values)
+
+    def test_file_backend(self):
+        """
+        Test keeping values in files shared by processes.
+        """
+        backend = backends.FileBackend(self.directory)
+        self.assert_backend_works(backend)
+        other = backends.FileBackend(self.directory)
+        self.assertEqual(other.get('key'), (None,))
+        self.assertEqual(other.incr('counter'), 3)
+        backend.set('expired', 1, timeout=-1)
+        self.assertIsNone(other.get('expired'))
+
+        locked = Event()
+
+        def lock():
+            """
+            Takes the lock in another thread.
+            """
+            with other.lock('key'):
+                locked.set()
+
+        with backend.lock('key'):
+            thread = Thread(target=lock)
+            thread.daemon = True
+            thread.start()
+            self.assertFalse(locked.wait(0.1))
+        self.assertTrue(locked.wait(1))
+
+    def test_file_backend_removes_expired(self):
+        """
+        Test files of expired values are removed.
+        """
+        backend = backends.FileBackend(self.directory)
+        with backend.lock('expired'):
+            backend.set('expired', 1, timeout=-1)
+        backend.set('kept', 2, timeout=60)
+        backend.set('forever', 3)
+        self.assertIsNone(backend.get('expired'))
+        self.assertFalse(os.path.exists(backend.path('expired')))
+        self.assertFalse(os.path.exists(backend.path('expired', '.lock')))
+
+        backend.set('swept', 4, timeout=-1)
+        with backend.lock('locked'):
+            backend.set('locked', 5, timeout=-1)
+            backend.swept = 0
+            backend.set('other', 6)
+        self.assertFalse(os.path.exists(backend.path('swept')))
+        self.assertTrue(os.path.exists(backend.path('locked')))
+        self.assertEqual(backend.get('kept'), 2)
+        self.assertEqual(backend.get('forever'), 3)
+
+        backend.sweep()
+        self.assertEqual(
+            sorted(os.listdir(self.directory)),
+            sorted([
+                os.path.basename(backend.path(key))
+                for key in ('kept', 'forever', 'other')
+            ])
+        )
+
+    def test_redis_backend(self):
+        """
+        Test keeping values in Redis.
+        """
+        client = FakeRedis()
+        backend = backends.RedisBackend(client)
+        self.assert_backend_works(backend)
+        self.assertIn('presence_analyzer:key', client.values)
+        self.assertNotIn('presence_analyzer:key:lock', client.values)
+
+    def test_make_backend(self):
+        """
+        Test creating backend from URL.
+        """
+        self.assertIsInstance(
+            backends.make_backend('memory://'),
+            backends.MemoryBackend
+        )
+        backend = backends.make_backend('file://' + self.directory)
+        self.assertIsInstance(backend, backends.FileBackend)
+        self.assertEqual(backend.directory, self.directory)
+        with self.assertRaises(ValueError):
+            backends.make_backend('memcached://localhost')
+
+    def test_shared_data(self):
+        """
+        Test sharing presence data by processes.
+        """
+        data = utils.get_data()
+        generation = utils.CACHE['generation']
+
+        # another process uses data loaded by the first one
+        utils.clear_cache()
+        self.assertDictEqual(utils.get_data(), data)
+        self.assertEqual(utils.CACHE['generation'], generation)
+
+        utils.get_data.refresh()
+        self.assertEqual(utils.CACHE['generation'], generation + 1)
+
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV_CACHE})
+        utils.clear_cache()
+        self.assertItemsEqual(utils.get_data().keys(), [62, 63])
+
+    def test_shared_store(self):
+        """
+        Test sharing memory bounded presence data.
+        """
+        main.app.config.update({'MEMORY_BUDGET': 1024 * 1024})
+        self.assertEqual(len(utils.get_data()[10]), 3)
+        utils.clear_cache()
+        store = utils.get_data()
+        self.assertIsInstance(store, storage.PresenceStore)
+        self.assertEqual(store.stats()['resident_users'], 0)
+        self.assertEqual(len(store[10]), 3)
+
+    def test_shared_results(self):
+        """
+        Test sharing results computed from presence data.
+        """
+        calls = []
+
+        def users(data, limit):
+            """
+            Returns sorted user ids.
+            """
+            calls.append(limit)
+            return sorted(data)[:limit]
+
+        first = utils.per_generation(users)
+        other = utils.per_generation(users)
+        self.assertEqual(first(1), [10])
+        self.assertEqual(other(1), [10])
+        self.assertEqual(other(2), [10, 11])
+        self.assertEqual(calls, [1, 2])
+
+
+class PresenceAnalyzerTasksTestCase(unittest.TestCase):
+    """
+    Background tasks tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        main.app.config.update({'DATA_XML': TEST_DATA_XML})
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        utils.clear_cache()
+
+    def test_periodic_task(self):
+        """
+        Test calling function periodically until task is stopped.
+        """
+        calls = []
+
+        def function():
+            """
+            Fails on first call, stops task on third one.
+            """
+            calls.append(None)
+            if len(calls) == 1:
+                raise ValueError()
+            if len(calls) == 3:
+                task.stop()
+
+        task = tasks.PeriodicTask(function, 0.01)
+        task.start()
+        task.join(1)
+        self.assertFalse(task.is_alive())
+        self.assertEqual(len(calls), 3)
+
+    def test_refresh_data(self):
+        """
+        Test refreshing presence data without fetching XML.
+        """
+        main.app.config.update({'DATA_XML_URL': 'file:///does/not/exist'})
+        utils.get_data()
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV_CACHE})
+        tasks.refresh_data()
+        self.assertItemsEqual(utils.get_data().keys(), [62, 63])
+        del main.app.config['DATA_XML_URL']
+
+    def test_fetch_xml_timeout(self):
+        """
+        Test hung users XML download gives up after timeout.
+        """
+        upstream = socket.socket()
+        upstream.bind(('127.0.0.1', 0))
+        upstream.listen(1)
+        main.app.config.update({
+            'DATA_XML_URL': 'http://127.0.0.1:{0}/users.xml'.format(
+                upstream.getsockname()[1]
+            ),
+            'DATA_XML_TIMEOUT': 0.2,
+        })
+        start = time.time()
+        try:
+            self.assertRaises(IOError, utils.update_xml_data)
+            tasks.fetch_xml()
+        finally:
+            upstream.close()
+            del main.app.config['DATA_XML_URL']
+            del main.app.config['DATA_XML_TIMEOUT']
+        self.assertLess(time.time() - start, 2)
+
+    def test_start_refresh(self):
+        """
+        Test fetching XML and refreshing data in separate tasks.
+        """
+        main.app.config.update({'DATA_XML_URL': 'file:///does/not/exist'})
+        started = tasks.start_refresh(60)
+        for task in started:
+            task.stop()
+            task.join(1)
+        self.assertEqual(
+            [task.name for task in started],
+            ['fetch_xml', 'refresh_data']
+        )
+
+        utils.WATCHER = object()
+        try:
+            started = tasks.start_refresh(60)
+        finally:
+            utils.WATCHER = None
+        for task in started:
+            task.stop()
+            task.join(1)
+        self.assertEqual([task.name for task in started], ['fetch_xml'])
+        del main.app.config['DATA_XML_URL']
+
+
+class PresenceAnalyzerStartupTestCase(unittest.TestCase):
+    """
+    Startup time tests.
+    """
+
+    def import_module(self, name):
+        """
+        Imports module in fresh interpreter.
+
+        Returns import time in seconds and names of loaded modules.
+        """
+        code = (
+            'import sys, time, json\n'
+            'start = time.time()\n'
+            'import {0}\n'
+            'print json.dumps([time.time() - start, sys.modules.keys()])\n'
+        ).format(name)
+        output = subprocess.check_output(
+            [sys.executable, '-c', code],
+            cwd=os.path.dirname(os.path.dirname(__file__)),
+        )
+        return json.loads(output)
+
+    def test_package_import(self):
+        """
+        Test importing package doesn't load the app.
+        """
+        elapsed, modules = self.import_module('presence_analyzer')
+        self.assertLess(elapsed, STARTUP_TIME_BUDGET)
+        self.assertNotIn('flask', modules)
+
+    def test_script_import(self):
+        """
+        Test command line tools don't load the app and heavy modules.
+        """
+        elapsed, modules = self.import_module('presence_analyzer.script')
+        self.assertLess(elapsed, STARTUP_TIME_BUDGET)
+        for name in ('flask', 'mako', 'lxml', 'presence_analyzer.main'):
+            self.assertNotIn(name, modules)
+
+    def test_utils_import(self):
+        """
+        Test XML parser is loaded on first use.
+        """
+        elapsed, modules = self.import_module('presence_analyzer.utils')
+        self.assertLess(elapsed, STARTUP_TIME_BUDGET)
+        self.assertNotIn('lxml', modules)
+
+    def test_warm_up(self):
+        """
+        Test loading data up front.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        utils.clear_cache()
+        start = time.time()
+        utils.warm_up()
+        self.assertLess(time.time() - start, STARTUP_TIME_BUDGET)
+        self.assertItemsEqual(utils.CACHE['data'].keys(), [10, 11])
+        self.assertIn('lxml.etree', sys.modules)
+
+        cached = utils.CACHE
+        utils.warm_up()
+        self.assertIs(utils.CACHE, cached)
+        self.assertEqual(utils.SNAPSHOTS, {})
+        utils.warm_up(force=True)
+        self.assertEqual(
+            utils.CACHE['generation'],
+            cached['generation'] + 1
+        )
+        utils.clear_cache()
+
+
+class PresenceAnalyzerPreforkTestCase(unittest.TestCase):
+    """
+    Pre-forking server tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, start the server with one worker.
+        """
+        self.directory = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.directory, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, self.csv_path)
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        self.port = probe.getsockname()[1]
+        probe.close()
+        code = (
+            'from presence_analyzer import main, views, prefork\n'
+            'main.app.config.update(DATA_CSV={0!r}, DATA_XML={1!r})\n'
+            'prefork.server_runner(main.app, {{}}, host="127.0.0.1",\n'
+            '                      port={2!r}, processes="1")\n'
+        ).format(self.csv_path, os.path.abspath(TEST_DATA_XML), str(self.port))
+        self.devnull = open(os.devnull, 'w')
+        self.server = subprocess.Popen(
+            [sys.executable, '-c', code],
+            cwd=os.path.dirname(os.path.dirname(__file__)),
+            stdout=self.devnull,
+            stderr=self.devnull,
+        )
+        self.wait_for(lambda: self.get('/api/v1/presence_weekday/10'))
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        if self.server.poll() is None:
+            self.server.kill()
+            for pid in self.workers():
+                os.kill(pid, signal.SIGKILL)
+            self.server.wait()
+        self.devnull.close()
+        shutil.rmtree(self.directory)
+
+    def wait_for(self, condition, timeout=10):
+        """
+        Waits until condition returns true value, returns the value.
+        """
+        deadline = time.time() + timeout
+        while True:
+            try:
+                result = condition()
+            except (IOError, OSError):
+                result = None
+            if result or time.time() > deadline:
+                return result
+            time.sleep(0.1)
+
+    def get(self, path):
+        """
+        Returns JSON response of the server.
+        """
+        url = 'http://127.0.0.1:{0}{1}'.format(self.port, path)
+        return json.loads(urllib2.urlopen(url, timeout=5).read())
+
+    def workers(self):
+        """
+        Returns pids of worker processes of the server.
+        """
+        pids = set()
+        for name in os.listdir('/proc'):
+            if not name.isdigit():
+                continue
+            try:
+                with open('/proc/{0}/stat'.format(name)) as statfile:
+                    stat = statfile.read()
+            except IOError:
+                continue
+            fields = stat[stat.rindex(')') + 2:].split()
+            if fields[0] != 'Z' and int(fields[1]) == self.server.pid:
+                pids.add(int(name))
+        return pids
+
+    def replaced_worker(self, old_pid):
+        """
+        Waits until the only worker isn't given one, returns its pid.
+        """
+        def replaced():
+            """
+            Returns pids of workers once old one is replaced.
+            """
+            pids = self.workers()
+            if len(pids) == 1 and old_pid not in pids:
+                return pids
+
+        pids = self.wait_for(replaced)
+        self.assertTrue(pids)
+        return pids.pop()
+
+    def test_signals(self):
+        """
+        Test refreshing, reloading, respawning and stopping workers.
+        """
+        workers = self.wait_for(self.workers)
+        self.assertEqual(len(workers), 1)
+        worker = workers.pop()
+        self.assertEqual(self.get('/api/v1/presence_weekday/10')[2],
+                         ['Tue', 30047])
+
+        # SIGUSR1 refreshes data in the parent and replaces worker
+        shutil.copy(TEST_DATA_CSV_CACHE, self.csv_path)
+        os.kill(self.server.pid, signal.SIGUSR1)
+        worker = self.replaced_worker(worker)
+        self.assertEqual(self.get('/api/v1/presence_weekday/10'), [])
+
+        # workers ignore control signals, SIGUSR2 replaces worker
+        os.kill(worker, signal.SIGUSR1)
+        os.kill(worker, signal.SIGHUP)
+        time.sleep(0.2)
+        self.assertEqual(self.workers(), set([worker]))
+        os.kill(self.server.pid, signal.SIGUSR2)
+        worker = self.replaced_worker(worker)
+        self.assertEqual(self.get('/api/v1/presence_weekday/10'), [])
+
+        # SIGHUP reloads data in the parent and replaces worker
+        shutil.copy(TEST_DATA_CSV, self.csv_path)
+        os.kill(self.server.pid, signal.SIGHUP)
+        worker = self.replaced_worker(worker)
+        self.assertEqual(self.get('/api/v1/presence_weekday/10')[2],
+                         ['Tue', 30047])
+
+        # crashed worker is respawned
+        os.kill(worker, signal.SIGKILL)
+        worker = self.replaced_worker(worker)
+        self.assertEqual(self.get('/api/v1/presence_weekday/10')[2],
+                         ['Tue', 30047])
+
+        # SIGTERM stops workers and the server
+        os.kill(self.server.pid, signal.SIGTERM)
+        self.assertEqual(
+            self.wait_for(lambda: self.server.poll() is not None),
+            True
+        )
+        self.assertEqual(self.server.returncode, 0)
+        self.assertEqual(self.workers(), set())
+
+
+class PresenceAnalyzerAsyncServerTestCase(unittest.TestCase):
+    """
+    Asynchronous server tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, start the server with two threads.
+        """
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        self.port = probe.getsockname()[1]
+        probe.close()
+        code = (
+            'from presence_analyzer import main, views, asyncserver\n'
+            'main.app.config.update(DATA_CSV={0!r}, DATA_XML={1!r})\n'
+            'asyncserver.server_runner(main.app, {{}}, host="127.0.0.1",\n'
+            '                          port={2!r}, threads="2")\n'
+        ).format(
+            os.path.abspath(TEST_DATA_CSV),
+            os.path.abspath(TEST_DATA_XML),
+            str(self.port),
+        )
+        self.devnull = open(os.devnull, 'w')
+        self.server = subprocess.Popen(
+            [sys.executable, '-c', code],
+            cwd=os.path.dirname(os.path.dirname(__file__)),
+            stdout=self.devnull,
+            stderr=self.devnull,
+        )
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            try:
+                self.get('/api/v1/users')
+                break
+            except IOError:
+                time.sleep(0.1)
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        self.server.kill()
+        self.server.wait()
+        self.devnull.close()
+
+    def get(self, path):
+        """
+        Returns body of the server's response.
+        """
+        url = 'http://127.0.0.1:{0}{1}'.format(self.port, path)
+        return urllib2.urlopen(url, timeout=5).read()
+
+    def test_serving(self):
+        """
+        Test serving API and streamed exports.
+        """
+        self.assertEqual(
+            json.loads(self.get('/api/v1/presence_weekday/10'))[2],
+            ['Tue', 30047]
+        )
+        lines = self.get('/api/v1/export/presence.csv').splitlines()
+        self.assertEqual(lines[0], 'user_id,date,start,end')
+        self.assertEqual(len(lines), 10)
+
+    def test_keep_alive_connections(self):
+        """
+        Test serving more keep-alive connections than threads at once.
+        """
+        url = 'http://127.0.0.1:{0}/api/v1/users'.format(self.port)
+        result = benchmark.benchmark(url, connections=20, requests=3)
+        self.assertEqual(result['errors'], 0)
+        self.assertEqual(result['requests'], 60)
+        self.assertGreater(result['rate'], 0)
+        self.assertLessEqual(result['median'], result['p99'])
+
+    def test_offload(self):
+        """
+        Test running the application and its response body in the pool.
+        """
+        from gevent.threadpool import ThreadPool
+        from werkzeug.test import Client
+        from werkzeug.wrappers import BaseResponse
+
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        pool = ThreadPool(1)
+        client = Client(asyncserver.Offload(main.app, pool), BaseResponse)
+        resp = client.get('/api/v1/export/statistics.csv')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            resp.data,
+            main.app.test_client().get('/api/v1/export/statistics.csv').data
+        )
+        self.assertEqual(client.get('/api/v1/nothing').status_code, 404)
+        pool.kill()
+        utils.clear_cache()
+
+
+class PresenceAnalyzerWatchTestCase(unittest.TestCase):
+    """
+    Watching data files tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.directory = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.directory, 'data.csv')
+        self.xml_path = os.path.join(self.directory, 'data.xml')
+        shutil.copy(TEST_DATA_CSV, self.csv_path)
+        shutil.copy(TEST_DATA_XML, self.xml_path)
+        main.app.config.update({'DATA_CSV': self.csv_path})
+        main.app.config.update({'DATA_XML': self.xml_path})
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        if utils.WATCHER is not None:
+            utils.WATCHER.stop()
+            utils.WATCHER.join()
+            utils.WATCHER = None
+        main.app.config.pop('WATCH_DELAY', None)
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        main.app.config.update({'DATA_XML': TEST_DATA_XML})
+        utils.clear_cache()
+        shutil.rmtree(self.directory)
+
+    def assert_backend_reports_changes(self, backend):
+        """
+        Checks changes of the CSV file are reported by given backend.
+        """
+        self.assertEqual(backend.wait(0.01), set())
+        with open(self.csv_path, 'a') as csvfile:
+            csvfile.write('\r\n12,2013-09-13,13:16:56,15:04:02')
+        os.utime(self.csv_path, (0, 0))
+        self.assertEqual(backend.wait(0.01), set([self.csv_path]))
+        self.assertEqual(backend.wait(0.01), set())
+        backend.close()
+
+    def test_inotify_backend(self):
+        """
+        Test reporting changes with inotify.
+        """
+        try:
+            backend = watch.InotifyBackend([self.csv_path, self.xml_path])
+        except (OSError, AttributeError):
+            self.skipTest('inotify is not available')
+        self.assert_backend_reports_changes(backend)
+
+    def test_inotify_other_files(self):
+        """
+        Test changes of other files in the directory don't end waiting.
+        """
+        try:
+            backend = watch.InotifyBackend([self.csv_path, self.xml_path])
+        except (OSError, AttributeError):
+            self.skipTest('inotify is not available')
+        with open(self.csv_path + '.idx', 'w') as indexfile:
+            indexfile.write('{}')
+        start = time.time()
+        self.assertEqual(backend.wait(0.2), set())
+        self.assertGreaterEqual(time.time() - start, 0.2)
+        backend.close()
+
+    def test_polling_backend(self):
+        """
+        Test reporting changes by polling files.
+        """
+        backend = watch.PollingBackend([self.csv_path, self.xml_path])
+        self.assert_backend_reports_changes(backend)
+
+    def test_watcher(self):
+        """
+        Test debounced notifications about changed files.
+        """
+        calls = []
+        changed = Event()
+
+        def callback(paths):
+            """
+            Records changed paths.
+            """
+            calls.append(paths)
+            changed.set()
+
+        watcher = watch.Watcher(
+            [self.csv_path],
+            callback,
+            0.05,
+            watch.PollingBackend([self.csv_path]),
+        )
+        watcher.start()
+        for i in range(3):
+            with open(self.csv_path, 'a') as csvfile:
+                csvfile.write('\r\n')
+        self.assertTrue(changed.wait(2))
+        watcher.stop()
+        watcher.join()
+        self.assertEqual(calls, [[self.csv_path]])
+
+    def test_watch_data(self):
+        """
+        Test refreshing presence data when file changes.
+        """
+        main.app.config.update({'WATCH_DELAY': 0.05})
+        self.assertItemsEqual(utils.get_data().keys(), [10, 11])
+        watcher = utils.watch_data()
+        self.assertIs(utils.watch_data(), watcher)
+
+        utils.CACHE['time'] = datetime.datetime(2000, 1, 1)
+        with open(self.csv_path, 'a') as csvfile:
+            csvfile.write('\r\n12,2013-09-13,13:16:56,15:04:02')
+        self.assertItemsEqual(utils.get_data().keys(), [10, 11])
+        for i in range(100):
+            if 12 in utils.get_data():
+                break
+            time.sleep(0.02)
+        self.assertItemsEqual(utils.get_data().keys(), [10, 11, 12])
+
+    def test_refresh_changed(self):
+        """
+        Test refreshing data loaded from changed files.
+        """
+        data = utils.get_data()
+        directory = utils.get_user_directory()
+        utils.refresh_changed([self.xml_path])
+        self.assertIs(utils.get_data(), data)
+        utils.refresh_changed([self.csv_path])
+        self.assertIsNot(utils.get_data(), data)
+        self.assertIsNot(utils.get_user_directory(), directory)
+
+    def test_notify_workers(self):
+        """
+        Test prefork parent refreshes its data before signalling workers.
+        """
+        received = []
+        handler = signal.signal(
+            signal.SIGUSR2,
+            lambda signum, frame: received.append(signum)
+        )
+        try:
+            data = utils.get_data()
+            prefork.notify_workers([self.csv_path])
+        finally:
+            signal.signal(signal.SIGUSR2, handler)
+        self.assertIsNot(utils.get_data(), data)
+        self.assertEqual(received, [signal.SIGUSR2])
+
 
 def suite():
     """
@@ -362,6 +2190,14 @@ def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsTestCase))
     suite.addTest(unittest.makeSuite(PresenceAnalyzerUtilsTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerStorageTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerAnomaliesTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerBackendsTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerTasksTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerPreforkTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerAsyncServerTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerWatchTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerStartupTestCase))
     return suite
 
 
@@ -3,70 +3,411 @@
 Helper functions used in views.
 """
 
+import os
 import csv
+import gzip
+import json
 import locale
+import calendar
 from json import dumps
-from functools import wraps
-from datetime import datetime
-from urllib import urlopen
+from functools import partial, wraps
+from itertools import count
+from operator import itemgetter
+from collections import namedtuple, OrderedDict
+from datetime import datetime, timedelta
+from cStringIO import StringIO
 from threading import Lock
 
-from flask import Response
-from lxml import etree
+from flask import Response, g, request, has_request_context
 
 from presence_analyzer.main import app
+from presence_analyzer.anomalies import AnomalyDetector
+from presence_analyzer.backends import make_backend
+from presence_analyzer.storage import (
+    PresenceStore,
+    data_stats,
+    parse_rows,
+    read_user,
+    source_signature,
+    user_aggregate,
+    user_bitmaps,
+)
 
 import logging
 log = logging.getLogger(__name__)  # pylint: disable=C0103
 
 CACHE = {}
+PENDING = {}
+STATISTICS_CACHE = {}
+DIRECTORY = {}
+INTERNED = {}
+BACKENDS = {}
+WATCHER = None
+SNAPSHOTS = OrderedDict()
 LOCK = Lock()
+SNAPSHOT_LOCK = Lock()
+
+GENERATION_HEADER = 'X-Data-Generation'
+
+GENERATIONS = count(1)
+OCCUPANCY_SLOT = 15 * 60
+# Number of quarters of an hour present in each 4 bits of presence bitmap.
+QUARTERS_PRESENT = [bin(quarters).count('1') for quarters in range(16)]
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+User = namedtuple('User', 'id name avatar present')  # pylint: disable=C0103
 
 
 def jsonify(function):
     """
     Creates a response with the JSON representation of wrapped function result.
+
+    Response tells generation of presence data it was computed from.
     """
     @wraps(function)
     def inner(*args, **kwargs):
         """
         Returns a response.
         """
-        return Response(dumps(function(*args, **kwargs)),
-                        mimetype='application/json')
+        response = Response(dumps(function(*args, **kwargs)),
+                            mimetype='application/json')
+        generation = getattr(g, 'data_generation', None)
+        if generation is not None:
+            response.headers[GENERATION_HEADER] = str(generation)
+        return response
     return inner
 
 
-def cache(seconds):
+def cache(seconds, version=None):
     """
     Caches the return content of a function.
+
+    Wrapped function gets 'refresh' attribute, which recomputes the content
+    and replaces cached one at once, so readers of fresh content never wait
+    for it. Content is computed under LOCK, so a load started earlier can't
+    replace newer content. Content doesn't expire while data files are
+    watched, see watch_data(), unless it has 'outdated' method telling so,
+    like PresenceStore. Replaced content is kept as a snapshot, see
+    retain_snapshot().
+
+    'version' function identifies source of the content, it's kept in the
+    cache. With CACHE_BACKEND setting, content is shared by processes, see
+    read_through(), 'version' tells which content can be shared.
     """
     def decorator(function):
-        def inner():
+        key = 'cache:{0}.{1}'.format(function.__module__, function.__name__)
+
+        def expired(cached):
+            """
+            Tells whether cached content has to be computed again.
+            """
+            if not cached:
+                return True
+            outdated = getattr(cached['data'], 'outdated', None)
+            if outdated is not None and outdated():
+                return True
+            age = (datetime.now() - cached['time']).seconds
+            return WATCHER is None and age > seconds
+
+        def refresh():
+            """
+            Recomputes cached content.
+            """
+            with LOCK:
+                return recompute()
+
+        def recompute():
+            """
+            Recomputes cached content, LOCK has to be held.
+            """
             global CACHE
-            if not CACHE or (datetime.now() - CACHE['time']).seconds > seconds:
+            previous = CACHE
+            backend = get_cache_backend()
+            if backend is None:
+                current = version() if version is not None else None
                 CACHE = {
                     'time': datetime.now(),
+                    'version': current,
                     'data': function(),
+                    'generation': take_generation(current),
                 }
+            else:
+                CACHE = read_through(backend, key, function, previous, version)
+            retain_snapshot(previous)
             return CACHE['data']
+
+        @wraps(function)
+        def inner():
+            cached = CACHE
+            if not expired(cached):
+                return cached['data']
+            with LOCK:
+                if not expired(CACHE):
+                    return CACHE['data']
+                return recompute()
+        inner.refresh = refresh
         return inner
     return decorator
 
 
-def lock(function):
+def get_cache_backend():
+    """
+    Returns cache backend configured by CACHE_BACKEND, None if there's none.
+    """
+    url = app.config.get('CACHE_BACKEND')
+    if not url:
+        return None
+    backend = BACKENDS.get(url)
+    if backend is None:
+        backend = BACKENDS[url] = make_backend(url)
+    return backend
+
+
+def read_through(backend, key, function, current, version=None):
+    """
+    Returns cached content newer than 'current' one, shared by processes.
+
+    Content is computed by one process while others wait for it, they
+    number generations from the shared counter. Shared content of another
+    version is computed again.
+    """
+    expected = version() if version is not None else None
+
+    def usable(entry):
+        """
+        Tells whether shared entry can replace the current one.
+        """
+        return (
+            entry is not None and
+            entry['generation'] > current.get('generation', 0) and
+            entry['version'] == expected
+        )
+
+    entry = backend.get(key)
+    if not usable(entry):
+        with backend.lock(key):
+            entry = backend.get(key)
+            if not usable(entry):
+                entry = {
+                    'time': datetime.now(),
+                    'data': function(),
+                    'generation': backend.incr('generation'),
+                    'version': expected,
+                }
+                backend.set(key, entry)
+    return entry
+
+
+def reserve_generation(version):
+    """
+    Returns generation presence data of given version gets once it's loaded.
+
+    Responses computed before the data is loaded are tagged with it, so they
+    tell the same generation as responses computed from the loaded data.
+    """
+    global PENDING
+    with SNAPSHOT_LOCK:
+        if CACHE.get('version') == version:
+            return CACHE['generation']
+        if PENDING.get('version') != version:
+            PENDING = {'version': version, 'generation': next(GENERATIONS)}
+        return PENDING['generation']
+
+
+def take_generation(version):
+    """
+    Returns generation of loaded presence data of given version.
+
+    It's the one reserved for the version if there's any, see
+    reserve_generation(), next one otherwise.
+    """
+    global PENDING
+    with SNAPSHOT_LOCK:
+        reserved, PENDING = PENDING, {}
+    if reserved and reserved['version'] == version:
+        return reserved['generation']
+    return next(GENERATIONS)
+
+
+def pending_version():
     """
-    Locks function.
+    Returns version of presence data which isn't loaded yet, None once it's
+    loaded.
+
+    The request is tagged with generation reserved for the data. Shared
+    cache numbers generations of all processes, so with CACHE_BACKEND
+    setting data is always loaded.
+    """
+    if CACHE or get_cache_backend() is not None:
+        return None
+    version = data_version()
+    generation = reserve_generation(version)
+    if has_request_context():
+        g.data_generation = generation
+    return version
+
+
+def retain_snapshot(cached):
+    """
+    Keeps replaced presence data for requests pinned to its generation.
+
+    At most SNAPSHOT_LIMIT snapshots are kept, each for SNAPSHOT_TTL seconds
+    after it was replaced, see prune_snapshots().
+    """
+    if cached:
+        with SNAPSHOT_LOCK:
+            SNAPSHOTS[cached['generation']] = {
+                'retired': datetime.now(),
+                'generation': cached['generation'],
+                'version': cached['version'],
+                'data': cached['data'],
+            }
+    prune_snapshots()
+
+
+def prune_snapshots():
+    """
+    Drops snapshots older than SNAPSHOT_TTL seconds and over SNAPSHOT_LIMIT.
+    """
+    ttl = timedelta(seconds=app.config.get('SNAPSHOT_TTL', 60))
+    limit = app.config.get('SNAPSHOT_LIMIT', 2)
+    now = datetime.now()
+    with SNAPSHOT_LOCK:
+        for generation, snapshot in SNAPSHOTS.items():
+            if now - snapshot['retired'] > ttl:
+                del SNAPSHOTS[generation]
+        while len(SNAPSHOTS) > limit:
+            SNAPSHOTS.popitem(last=False)
+
+
+def get_snapshot(generation):
+    """
+    Returns retained snapshot of given generation, None if it's gone.
+
+    Snapshot has 'generation', 'version' and 'data' of cached content.
+    """
+    prune_snapshots()
+    return SNAPSHOTS.get(generation)
+
+
+def get_served():
+    """
+    Returns cached presence data served to the request.
+
+    It's current data unless the request pins retained generation with
+    X-Data-Generation header, see get_generation(). Returned dict has
+    'generation', 'version' and 'data' keys.
+    """
+    load_data()
+    served = CACHE
+    if SNAPSHOTS:
+        prune_snapshots()
+    if has_request_context():
+        pinned = request.headers.get(GENERATION_HEADER, type=int)
+        if pinned is not None and pinned != served['generation']:
+            snapshot = get_snapshot(pinned)
+            if snapshot is not None:
+                served = snapshot
+        g.data_generation = served['generation']
+    return served
+
+
+def get_generation():
+    """
+    Returns (generation, data) pair of presence data served to the request.
+
+    Generation is increased every time presence data is loaded. Requests
+    can pin generation with X-Data-Generation header and they're served
+    its snapshot while it's retained, current data otherwise.
     """
-    def inner():
-        with LOCK:
-            return function()
+    served = get_served()
+    return served['generation'], served['data']
+
+
+def per_generation(function=None, limit=None):
+    """
+    Caches results of a function of presence data until data is reloaded.
+
+    Wrapped function gets presence data as first argument. Results of
+    retained snapshots are kept as well, until the snapshots are dropped.
+    With 'limit', at most that many least recently used results are kept
+    per generation. With CACHE_BACKEND setting, results are shared by
+    processes.
+    """
+    if function is None:
+        return partial(per_generation, limit=limit)
+    state = {}
+    state_lock = Lock()
+
+    @wraps(function)
+    def inner(*args):
+        generation, data = get_generation()
+        alive = set(SNAPSHOTS)
+        alive.add(generation)
+        with state_lock:
+            for old_generation in state.keys():
+                if old_generation not in alive:
+                    del state[old_generation]
+            results = state.setdefault(generation, OrderedDict())
+            if args in results:
+                result = results[args] = results.pop(args)
+                return result
+
+        backend = get_cache_backend()
+        if backend is None:
+            result = function(data, *args)
+        else:
+            key = 'per_generation:{0}.{1}:{2}:{3!r}'.format(
+                function.__module__, function.__name__, generation, args
+            )
+            result = read_result(backend, key, function, data, args)
+        with state_lock:
+            results[args] = result
+            while limit is not None and len(results) > limit:
+                results.popitem(last=False)
+        return result
     return inner
 
 
-@lock
-@cache(600)
-def get_data():
+def read_result(backend, key, function, data, args):
+    """
+    Returns result of a function shared by processes, computing it once.
+
+    Results expire after CACHE_TIMEOUT seconds.
+    """
+    cached = backend.get(key)
+    if cached is None:
+        with backend.lock(key):
+            cached = backend.get(key)
+            if cached is None:
+                cached = (function(data, *args),)
+                backend.set(key, cached, app.config.get('CACHE_TIMEOUT', 3600))
+    return cached[0]
+
+
+def clear_cache():
+    """
+    Drops cached data, so it's loaded again on next access.
+    """
+    global CACHE, PENDING, DIRECTORY
+    CACHE = {}
+    PENDING = {}
+    DIRECTORY = {}
+    SNAPSHOTS.clear()
+
+
+def data_version():
+    """
+    Identifies presence data by version of DATA_CSV and the loading mode.
+    """
+    return [
+        source_signature(app.config['DATA_CSV']),
+        app.config.get('MEMORY_BUDGET'),
+    ]
+
+
+@cache(600, data_version)
+def load_data():
     """
     Extracts presence data from CSV file and groups it by user_id.
 
@@ -83,58 +424,298 @@ def get_data():
             },
         }
     }
+
+    When MEMORY_BUDGET setting is given, returns PresenceStore which reads
+    users' data on demand and keeps at most that many bytes of it.
     """
-    data = {}
+    budget = app.config.get('MEMORY_BUDGET')
+    if budget:
+        return PresenceStore(app.config['DATA_CSV'], budget)
+
     with open(app.config['DATA_CSV'], 'r') as csvfile:
-        presence_reader = csv.reader(csvfile, delimiter=',')
-        for i, row in enumerate(presence_reader):
-            if len(row) != 4:
-                # ignore header and footer lines
-                continue
+        return parse_rows(csvfile, make_detector())
 
-            try:
-                user_id = int(row[0])
-                date = datetime.strptime(row[1], '%Y-%m-%d').date()
-                start = datetime.strptime(row[2], '%H:%M:%S').time()
-                end = datetime.strptime(row[3], '%H:%M:%S').time()
-            except (ValueError, TypeError):
-                log.debug('Problem with line %d: ', i, exc_info=True)
 
-            data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
-    return data
+def make_detector():
+    """
+    Creates anomaly detector configured by application settings.
 
+    ANOMALY_THRESHOLD is number of standard deviations from the norm and
+    ANOMALY_MIN_SAMPLES number of days needed to know the norm.
+    """
+    return AnomalyDetector(
+        app.config.get('ANOMALY_THRESHOLD', 3),
+        app.config.get('ANOMALY_MIN_SAMPLES', 5),
+    )
 
-def get_xml_data():
+
+@per_generation
+def find_anomalies(data):
     """
-    Extracts user data from XML file.
+    Returns anomalies of presence data sorted by date.
+
+    Anomalies are found while presence data is loaded, in memory bounded
+    mode they're found on first use.
+    """
+    anomalies = getattr(data, 'anomalies', None)
+    if anomalies is None:
+        detector = make_detector()
+        for user_id, items in iter_users(data):
+            detector.add_user(user_id, items)
+        anomalies = detector.anomalies
+    return sorted(anomalies, key=itemgetter('date', 'user_id', 'field'))
+
+
+def get_anomalies(user_id=None):
+    """
+    Returns anomalies of presence data sorted by date, optionally of a user.
+
+    Anomalies of all users are found once per generation, see
+    find_anomalies().
+    """
+    anomalies = find_anomalies()
+    if user_id is None:
+        return anomalies
+    return [item for item in anomalies if item['user_id'] == user_id]
+
+
+def iter_users(data, user_ids=None):
+    """
+    Yields (user_id, items) pairs of presence data of all or given users.
+
+    Memory bounded store reads users without keeping them, so full scans
+    don't evict recently used users.
+    """
+    if isinstance(data, PresenceStore):
+        return data.iter_users(user_ids)
+    if user_ids is None:
+        return data.iteritems()
+    return (
+        (user_id, data[user_id]) for user_id in user_ids if user_id in data
+    )
+
+
+def get_data():
+    """
+    Returns presence data served to the request, see get_generation().
+    """
+    return get_generation()[1]
+
+
+get_data.refresh = load_data.refresh
+
+
+def get_user_data(user_id):
     """
-    data = {}
+    Returns presence data of given user served to the request, None if user
+    has no data.
+
+    Until presence data is loaded, only rows of the user are read from
+    DATA_CSV using its index, see pending_version().
+    """
+    if pending_version() is not None:
+        return read_user(app.config['DATA_CSV'], user_id)
+    return get_data().get(user_id)
+
+
+def refresh_changed(paths):
+    """
+    Refreshes data loaded from given changed files.
+    """
+    if app.config['DATA_CSV'] in paths:
+        log.info('Reloading %s', app.config['DATA_CSV'])
+        get_data.refresh()
+    if app.config['DATA_XML'] in paths:
+        log.info('Reloading %s', app.config['DATA_XML'])
+        get_user_directory()
+
+
+def watch_data():
+    """
+    Refreshes data as soon as DATA_CSV or DATA_XML file changes.
+
+    Cached data doesn't expire afterwards. Refresh waits WATCH_DELAY seconds
+    after the last change, so files being written aren't loaded.
+    """
+    global WATCHER
+    from presence_analyzer.watch import Watcher
+
+    if WATCHER is None:
+        WATCHER = Watcher(
+            [app.config['DATA_CSV'], app.config['DATA_XML']],
+            refresh_changed,
+            app.config.get('WATCH_DELAY', 1),
+        )
+        WATCHER.start()
+    return WATCHER
+
+
+def get_memory_stats():
+    """
+    Returns memory usage of presence data and eviction counters.
+    """
+    return data_stats(get_data())
+
+
+def collation_keys(names):
+    """
+    Calculates keys sorting names in Polish alphabetical order.
+
+    Names are sorted by code points when Polish locale isn't available.
+    """
+    try:
+        locale.setlocale(locale.LC_COLLATE, 'pl_PL.UTF-8')
+    except locale.Error:
+        log.warning('Polish locale is not available', exc_info=True)
+    try:
+        return [locale.strxfrm(name.encode('utf-8')) for name in names]
+    finally:
+        locale.setlocale(locale.LC_COLLATE, (None, None))
+
+
+def parse_xml_users():
+    """
+    Extracts (id, name, avatar, group) of users from XML file.
+
+    Group is read from user attribute named by GROUP_ATTRIBUTE setting,
+    'team' by default.
+    """
+    from lxml import etree
+
     with open(app.config['DATA_XML'], 'r') as xmlfile:
         tree = etree.parse(xmlfile)
-        host = tree.findtext('./server/host')
-        protocol = tree.findtext('./server/protocol')
-        url = '{0}://{1}'.format(protocol, host)
+    host = tree.findtext('./server/host')
+    protocol = tree.findtext('./server/protocol')
+    url = '{0}://{1}'.format(protocol, host)
+    group_attribute = app.config.get('GROUP_ATTRIBUTE', 'team')
+
+    return [(
+        int(user.get('id')),
+        user.findtext('name'),
+        '{0}{1}'.format(url, user.findtext('avatar')),
+        user.get(group_attribute),
+    ) for user in tree.findall('./users/user')]
+
+
+def get_xml_data():
+    """
+    Extracts user data from XML file.
+    """
+    users = parse_xml_users()
+    keys = collation_keys([user[1] for user in users])
+    return [{
+        'id': user_id,
+        'name': name,
+        'avatar': avatar,
+    } for key, (user_id, name, avatar, group) in sorted(zip(keys, users))]
+
+
+def intern_string(text):
+    """
+    Returns shared instance of equal string.
+    """
+    return INTERNED.setdefault(text, text)
+
+
+def build_user_directory(data, xml_users):
+    """
+    Joins users from XML file with users having presence data.
+
+    Returns ordered dict of User tuples keyed by user_id and sorted by name.
+    Users without XML entry get generated name and no avatar.
+    """
+    names = {
+        user_id: (intern_string(name), intern_string(avatar))
+        for user_id, name, avatar, group in xml_users
+    }
+    user_ids = set(names) | set(data)
+    generated = {
+        user_id: (intern_string(u'User {0}'.format(user_id)), None)
+        for user_id in user_ids - set(names)
+    }
+    names.update(generated)
 
-        users = tree.findall('./users/user')
-        locale.setlocale(locale.LC_ALL, 'pl_PL.UTF-8')
-        users.sort(key=lambda k: k.findtext('name'), cmp=locale.strcoll)
-        locale.setlocale(locale.LC_ALL, (None, None))
+    users = [
+        (user_id, names[user_id][0], names[user_id][1], user_id in data)
+        for user_id in user_ids
+    ]
+    keys = collation_keys([name for user_id, name, avatar, present in users])
+    return OrderedDict(
+        (user[0], User(*user))
+        for key, user in sorted(zip(keys, users))
+    )
 
-        data = [{
-            'id': int(user.get('id')),
-            'name': user.findtext('name'),
-            'avatar': '{0}{1}'.format(url, user.findtext('avatar')),
-        } for user in users]
 
-    return data
+def build_groups(xml_users):
+    """
+    Groups user ids by group names from XML and GROUPS setting.
+    """
+    groups = {}
+    for name, user_ids in app.config.get('GROUPS', {}).items():
+        groups.setdefault(name, set()).update(user_ids)
+    for user_id, name, avatar, group in xml_users:
+        if group:
+            groups.setdefault(group, set()).add(user_id)
+    return {name: tuple(sorted(user_ids)) for name, user_ids in groups.items()}
+
+
+def get_user_directory():
+    """
+    Returns user directory, rebuilt when presence data or XML file changes.
+
+    Directory holds precomputed user listings, under 'users' key listing of
+    users with presence data and under 'xml_users' one of users from XML.
+    Under 'groups' key there are user ids of each group.
+    """
+    global DIRECTORY
+    generation, data = get_generation()
+    try:
+        xml_signature = source_signature(app.config['DATA_XML'])
+    except OSError:
+        xml_signature = None
+
+    if DIRECTORY.get('generation') == generation and \
+            DIRECTORY.get('xml_signature') == xml_signature:
+        return DIRECTORY
+
+    xml_users = parse_xml_users() if xml_signature is not None else []
+    users = build_user_directory(data, xml_users)
+    DIRECTORY = {
+        'generation': generation,
+        'xml_signature': xml_signature,
+        'directory': users,
+        'users': [
+            {'user_id': user.id, 'name': user.name}
+            for user in users.values() if user.present
+        ],
+        'xml_users': [
+            {'id': user.id, 'name': user.name, 'avatar': user.avatar}
+            for user in users.values() if user.avatar is not None
+        ],
+        'groups': build_groups(xml_users),
+    }
+    return DIRECTORY
 
 
 def update_xml_data():
     """
     Updates local xml file with newest one.
+
+    File is replaced at once, so readers never see partially written data.
+    Download fails with IOError after DATA_XML_TIMEOUT seconds of silence.
     """
-    with open('runtime/data/sample_xml_data.xml', 'wb') as xmlfile:
-        xmlfile.write(urlopen('http://sargo.bolt.stxnext.pl/users.xml').read())
+    from urllib2 import urlopen
+
+    url = app.config.get(
+        'DATA_XML_URL',
+        'http://sargo.bolt.stxnext.pl/users.xml'
+    )
+    path = app.config.get('DATA_XML', 'runtime/data/sample_xml_data.xml')
+    timeout = app.config.get('DATA_XML_TIMEOUT', 30)
+    content = urlopen(url, timeout=timeout).read()
+    with open(path + '.tmp', 'wb') as xmlfile:
+        xmlfile.write(content)
+    os.rename(path + '.tmp', path)
 
 
 def group_by_weekday(items):
@@ -181,3 +762,460 @@ def mean(items):
     Calculates arithmetic mean. Returns zero for empty lists.
     """
     return float(sum(items)) / len(items) if len(items) > 0 else 0
+
+
+def mean_time_weekday(items):
+    """
+    Calculates mean presence time grouped by weekday.
+    """
+    weekdays = group_by_weekday(items)
+    return [(calendar.day_abbr[weekday], mean(intervals))
+            for weekday, intervals in weekdays.items()]
+
+
+def presence_weekday(items):
+    """
+    Calculates total presence time grouped by weekday.
+    """
+    weekdays = group_by_weekday(items)
+    result = [(calendar.day_abbr[weekday], sum(intervals))
+              for weekday, intervals in weekdays.items()]
+    result.insert(0, ('Weekday', 'Presence (s)'))
+    return result
+
+
+def presence_start_end(items):
+    """
+    Calculates mean start, end time of presence grouped by weekday.
+    """
+    weekdays = group_start_end_by_weekday(items)
+    return [
+        (calendar.day_abbr[weekday],
+         mean(start_end_dict['start']),
+         mean(start_end_dict['end']))
+        for weekday, start_end_dict in weekdays.items()
+    ]
+
+
+def per_day(value, days):
+    """
+    Divides value summed over days by their number, zero without days.
+    """
+    return float(value) / days if days else 0
+
+
+def aggregate_statistics(aggregate):
+    """
+    Calculates all statistics of a user from weekday sums of presence, see
+    user_aggregate(). They're equal to results of STATISTICS functions.
+    """
+    weekdays = [
+        (calendar.day_abbr[weekday], days, total, start, end)
+        for weekday, (days, total, start, end) in enumerate(aggregate)
+    ]
+    presence = [(name, total) for name, days, total, _, _ in weekdays]
+    presence.insert(0, ('Weekday', 'Presence (s)'))
+    return {
+        'mean_time_weekday': [
+            (name, per_day(total, days))
+            for name, days, total, _, _ in weekdays
+        ],
+        'presence_weekday': presence,
+        'presence_start_end': [
+            (name, per_day(start, days), per_day(end, days))
+            for name, days, _, start, end in weekdays
+        ],
+    }
+
+
+def weekday_aggregate(items):
+    """
+    Calculates mergeable (days, total presence) pairs of each weekday.
+    """
+    result = [[0, 0] for i in range(7)]
+    for date in items:
+        weekday = result[date.weekday()]
+        weekday[0] += 1
+        weekday[1] += interval(items[date]['start'], items[date]['end'])
+    return result
+
+
+def merge_aggregates(aggregates):
+    """
+    Sums weekday aggregates of many users.
+    """
+    result = [[0, 0] for i in range(7)]
+    for aggregate in aggregates:
+        for weekday, (days, total) in enumerate(aggregate):
+            result[weekday][0] += days
+            result[weekday][1] += total
+    return result
+
+
+@per_generation
+def get_user_aggregates(data):
+    """
+    Returns weekday aggregates of all users.
+
+    Memory bounded store keeps aggregates of its users, so they aren't read.
+    """
+    aggregates = getattr(data, 'aggregates', None)
+    if aggregates is not None:
+        return {
+            user_id: [[days, total] for days, total, _, _ in aggregate]
+            for user_id, aggregate in aggregates.items()
+        }
+    return {
+        user_id: weekday_aggregate(items)
+        for user_id, items in iter_users(data)
+    }
+
+
+@per_generation
+def group_mean_time_weekday(data, user_ids):  # pylint: disable=W0613
+    """
+    Calculates mean presence time of group members grouped by weekday.
+    """
+    aggregates = get_user_aggregates()
+    merged = merge_aggregates(
+        aggregates[user_id] for user_id in user_ids if user_id in aggregates
+    )
+    return [(calendar.day_abbr[weekday], per_day(total, days))
+            for weekday, (days, total) in enumerate(merged)]
+
+
+@per_generation(limit=32)
+def occupancy(data, start_date, end_date, weekday=None):
+    """
+    Calculates mean number of present users in each time slot of a day.
+
+    Only days between 'start_date' and 'end_date' (inclusive) falling on
+    given weekday are taken, days without any presence are skipped. Returns
+    ('HH:MM', mean) pairs, one per OCCUPANCY_SLOT seconds.
+    """
+    slots = 24 * 3600 // OCCUPANCY_SLOT
+    changes = [0] * (slots + 1)
+    days = set()
+    for _, items in iter_users(data):
+        for date, entry in items.items():
+            if not start_date <= date <= end_date:
+                continue
+            if weekday is not None and date.weekday() != weekday:
+                continue
+            start = seconds_since_midnight(entry['start'])
+            end = seconds_since_midnight(entry['end'])
+            if end <= start:
+                continue
+            days.add(date)
+            changes[start // OCCUPANCY_SLOT] += 1
+            changes[(end - 1) // OCCUPANCY_SLOT + 1] -= 1
+
+    result = []
+    present = 0
+    for slot in range(slots):
+        present += changes[slot]
+        minutes = slot * OCCUPANCY_SLOT // 60
+        result.append((
+            '{0:02d}:{1:02d}'.format(minutes // 60, minutes % 60),
+            float(present) / len(days) if days else 0,
+        ))
+    return result
+
+
+def presence_heatmap(bitmaps):
+    """
+    Calculates probability of presence in each hour grouped by weekday.
+
+    Takes presence bitmaps of user's days, see day_bitmap(). Probability is
+    the part of hour's quarters user was present in, over all days of the
+    weekday. Returns (weekday, [probability of each hour]) pairs.
+    """
+    quarters = [[0] * 24 for weekday in range(7)]
+    days = [0] * 7
+    for date, bitmap in bitmaps.items():
+        weekday = date.weekday()
+        days[weekday] += 1
+        hours = quarters[weekday]
+        hour = 0
+        while bitmap:
+            hours[hour] += QUARTERS_PRESENT[bitmap & 0xF]
+            bitmap >>= 4
+            hour += 1
+    return [
+        (calendar.day_abbr[weekday],
+         [round(present / (4.0 * days[weekday]), 2) if days[weekday] else 0
+          for present in quarters[weekday]])
+        for weekday in range(7)
+    ]
+
+
+def get_user_heatmap(user_id):
+    """
+    Returns presence heatmap of given user, None if user has no data.
+
+    Until presence data is loaded, it's computed from rows of the user read
+    by get_user_data().
+    """
+    if pending_version() is None:
+        return loaded_user_heatmap(user_id)
+    items = get_user_data(user_id)
+    if items is None:
+        return None
+    return presence_heatmap(user_bitmaps(items))
+
+
+@per_generation(limit=1024)
+def loaded_user_heatmap(data, user_id):
+    """
+    Returns presence heatmap of given user from loaded presence data.
+
+    Bitmaps are computed while presence data is loaded, in memory bounded
+    mode they're computed on first use.
+    """
+    if user_id not in data:
+        return None
+    bitmaps = getattr(data, 'bitmaps', None)
+    if bitmaps is None:
+        return presence_heatmap(user_bitmaps(data[user_id]))
+    return presence_heatmap(bitmaps[user_id])
+
+
+def statistics_rows(data, user_ids=None):
+    """
+    Yields header and per user, per weekday statistics rows.
+
+    Rows hold user_id, weekday, number of days, total, mean presence time,
+    mean start and end time in seconds. Memory bounded store keeps
+    aggregates of its users, so they aren't read.
+    """
+    yield ('user_id', 'weekday', 'days', 'total', 'mean', 'start', 'end')
+    user_ids = sorted(data if user_ids is None else user_ids)
+    aggregates = getattr(data, 'aggregates', None)
+    if aggregates is None:
+        users = (
+            (user_id, user_aggregate(items))
+            for user_id, items in iter_users(data, user_ids)
+        )
+    else:
+        users = (
+            (user_id, aggregates[user_id])
+            for user_id in user_ids if user_id in aggregates
+        )
+    for user_id, aggregate in users:
+        for weekday, (days, total, start, end) in enumerate(aggregate):
+            yield (
+                user_id,
+                calendar.day_abbr[weekday],
+                days,
+                total,
+                per_day(total, days),
+                per_day(start, days),
+                per_day(end, days),
+            )
+
+
+def presence_rows(data, user_ids=None, start_date=None, end_date=None):
+    """
+    Yields header and raw presence rows, optionally filtered.
+    """
+    yield ('user_id', 'date', 'start', 'end')
+    user_ids = sorted(data if user_ids is None else user_ids)
+    for user_id, items in iter_users(data, user_ids):
+        for date in sorted(items):
+            if start_date is not None and date < start_date:
+                continue
+            if end_date is not None and date > end_date:
+                continue
+            yield (
+                user_id,
+                date.isoformat(),
+                items[date]['start'].isoformat(),
+                items[date]['end'].isoformat(),
+            )
+
+
+def csv_chunks(rows):
+    """
+    Formats rows as CSV, yields chunks of about EXPORT_CHUNK_SIZE bytes.
+    """
+    buf = StringIO()
+    writer = csv.writer(buf, lineterminator='\n')
+    for row in rows:
+        writer.writerow(row)
+        if buf.tell() >= EXPORT_CHUNK_SIZE:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
+
+
+def ndjson_chunks(rows):
+    """
+    Formats rows as JSON objects, one per line, yields chunks of them.
+    """
+    rows = iter(rows)
+    header = next(rows)
+    lines = []
+    size = 0
+    for row in rows:
+        line = dumps(dict(zip(header, row))) + '\n'
+        lines.append(line)
+        size += len(line)
+        if size >= EXPORT_CHUNK_SIZE:
+            yield ''.join(lines)
+            lines = []
+            size = 0
+    if lines:
+        yield ''.join(lines)
+
+
+EXPORT_FORMATS = {
+    'csv': (csv_chunks, 'text/csv'),
+    'ndjson': (ndjson_chunks, 'application/x-ndjson'),
+}
+
+
+def stream_rows(rows, export_format):
+    """
+    Creates a response streaming rows in given format.
+
+    Rows are formatted while the response is sent, so memory use doesn't
+    grow with their number.
+    """
+    formatter, mimetype = EXPORT_FORMATS[export_format]
+    response = Response(formatter(rows), mimetype=mimetype)
+    generation = getattr(g, 'data_generation', None)
+    if generation is not None:
+        response.headers[GENERATION_HEADER] = str(generation)
+    return response
+
+
+STATISTICS = {
+    'mean_time_weekday': mean_time_weekday,
+    'presence_weekday': presence_weekday,
+    'presence_start_end': presence_start_end,
+}
+
+
+def user_statistics(user):
+    """
+    Calculates all statistics of single (user_id, items) pair.
+    """
+    user_id, items = user
+    return user_id, {
+        name: function(items) for name, function in STATISTICS.items()
+    }
+
+
+def dump_statistics(path, processes=None):
+    """
+    Calculates statistics of all users in parallel and stores them in file.
+
+    File is gzipped JSON, it's loaded by get_statistics(). It records
+    version of DATA_CSV the statistics were computed from, which is the
+    version of loaded data, even if the file has changed since.
+    """
+    from multiprocessing import Pool
+
+    served = get_served()
+    data = served['data']
+    pool = Pool(processes)
+    try:
+        users = dict(
+            pool.imap_unordered(user_statistics, iter_users(data), 16)
+        )
+    finally:
+        pool.close()
+        pool.join()
+
+    content = {
+        'source': served['version'][0],
+        'users': users,
+    }
+    with gzip.open(path + '.tmp', 'wb') as statsfile:
+        json.dump(content, statsfile, separators=(',', ':'))
+    os.rename(path + '.tmp', path)
+    return users
+
+
+def get_statistics(source=None):
+    """
+    Loads precomputed statistics from DATA_STATS file.
+
+    Returns None when there's no such file or it was computed from different
+    version of DATA_CSV than 'source' signature, current one by default.
+    """
+    global STATISTICS_CACHE
+    path = app.config.get('DATA_STATS')
+    if not path or not os.path.exists(path):
+        return None
+
+    signature = source_signature(path)
+    if STATISTICS_CACHE.get('signature') != signature:
+        with gzip.open(path, 'rb') as statsfile:
+            content = json.load(statsfile)
+        STATISTICS_CACHE = {
+            'signature': signature,
+            'source': content['source'],
+            'users': {
+                int(user_id): statistics
+                for user_id, statistics in content['users'].items()
+            },
+        }
+
+    if source is None:
+        source = source_signature(app.config['DATA_CSV'])
+    if STATISTICS_CACHE['source'] != source:
+        log.debug('Precomputed statistics are outdated')
+        return None
+    return STATISTICS_CACHE['users']
+
+
+def warm_up(force=False):
+    """
+    Loads data and heavy modules up front instead of on first request.
+
+    Data already cached is kept unless it's forced to reload.
+    """
+    from lxml import etree  # pylint: disable=W0612
+
+    if force:
+        get_data.refresh()
+    else:
+        get_data()
+    get_statistics()
+
+
+def get_user_statistic(name, user_id):
+    """
+    Returns given statistic of the user, None if user has no data.
+
+    Statistic comes from presence data served to the request, precomputed
+    statistics are used when they were computed from the same data, memory
+    bounded store serves them from its aggregates. Until presence data is
+    loaded, only rows of the user are read from DATA_CSV, see
+    pending_version().
+    """
+    version = pending_version()
+    served = get_served() if version is None else None
+    if served is not None:
+        version = served['version']
+    statistics = get_statistics(version[0])
+    if statistics is not None:
+        if user_id not in statistics:
+            return None
+        return statistics[user_id][name]
+
+    if served is None:
+        items = read_user(app.config['DATA_CSV'], user_id)
+    else:
+        aggregates = getattr(served['data'], 'aggregates', None)
+        if aggregates is not None:
+            if user_id not in aggregates:
+                return None
+            return aggregate_statistics(aggregates[user_id])[name]
+        items = served['data'].get(user_id)
+    if items is None:
+        return None
+    return STATISTICS[name](items)
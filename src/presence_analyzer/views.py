@@ -3,19 +3,27 @@
 Defines views.
 """
 
-import calendar
-from flask import redirect, abort
+from datetime import date, datetime
+
+from flask import redirect, abort, request
 from flask.ext.mako import render_template
 from mako.exceptions import TopLevelLookupException
 
 from presence_analyzer.main import app
 from presence_analyzer.utils import (
     jsonify,
+    EXPORT_FORMATS,
+    get_anomalies,
     get_data,
-    mean,
-    group_by_weekday,
-    group_start_end_by_weekday,
-    get_xml_data
+    get_memory_stats,
+    get_user_heatmap,
+    get_user_directory,
+    get_user_statistic,
+    group_mean_time_weekday,
+    occupancy,
+    presence_rows,
+    statistics_rows,
+    stream_rows,
 )
 
 import logging
@@ -47,9 +55,7 @@ def users_view():
     """
     Users listing for dropdown.
     """
-    data = get_data()
-    return [{'user_id': i, 'name': 'User {0}'.format(str(i))}
-            for i in data.keys()]
+    return get_user_directory()['users']
 
 
 @app.route('/api/v2/users')
@@ -58,7 +64,7 @@ def users_xml_view():
     """
     Users with name, avatar listing.
     """
-    return get_xml_data()
+    return get_user_directory()['xml_users']
 
 
 @app.route('/api/v1/mean_time_weekday/<int:user_id>', methods=['GET'])
@@ -67,15 +73,10 @@ def mean_time_weekday_view(user_id):
     """
     Returns mean presence time of given user grouped by weekday.
     """
-    data = get_data()
-    if user_id not in data:
+    result = get_user_statistic('mean_time_weekday', user_id)
+    if result is None:
         log.debug('User %s not found!', user_id)
         return []
-
-    weekdays = group_by_weekday(data[user_id])
-    result = [(calendar.day_abbr[weekday], mean(intervals))
-              for weekday, intervals in weekdays.items()]
-
     return result
 
 
@@ -85,16 +86,10 @@ def presence_weekday_view(user_id):
     """
     Returns total presence time of given user grouped by weekday.
     """
-    data = get_data()
-    if user_id not in data:
+    result = get_user_statistic('presence_weekday', user_id)
+    if result is None:
         log.debug('User %s not found!', user_id)
         return []
-
-    weekdays = group_by_weekday(data[user_id])
-    result = [(calendar.day_abbr[weekday], sum(intervals))
-              for weekday, intervals in weekdays.items()]
-
-    result.insert(0, ('Weekday', 'Presence (s)'))
     return result
 
 
@@ -104,16 +99,155 @@ def presence_start_end_view(user_id):
     """
     Returns start, end time when user is most often present grouped by weekday.
     """
-    data = get_data()
-    if user_id not in data:
+    result = get_user_statistic('presence_start_end', user_id)
+    if result is None:
         log.debug('User %s not found!', user_id)
         return []
+    return result
 
-    weekdays = group_start_end_by_weekday(data[user_id])
-    result = [
-        (calendar.day_abbr[weekday],
-         mean(start_end_dict['start']),
-         mean(start_end_dict['end']))
-        for weekday, start_end_dict in weekdays.items()
-    ]
+
+@app.route('/api/v1/presence_heatmap/<int:user_id>', methods=['GET'])
+@jsonify
+def presence_heatmap_view(user_id):
+    """
+    Returns probability of presence of given user in each hour by weekday.
+    """
+    result = get_user_heatmap(user_id)
+    if result is None:
+        log.debug('User %s not found!', user_id)
+        return []
     return result
+
+
+@app.route('/api/v1/groups', methods=['GET'])
+@jsonify
+def groups_view():
+    """
+    Groups listing with ids of their members.
+    """
+    groups = get_user_directory()['groups']
+    return [{'name': name, 'user_ids': user_ids}
+            for name, user_ids in sorted(groups.items())]
+
+
+@app.route('/api/v1/mean_time_weekday/group/<group>', methods=['GET'])
+@jsonify
+def group_mean_time_weekday_view(group):
+    """
+    Returns mean presence time of group members grouped by weekday.
+    """
+    user_ids = get_user_directory()['groups'].get(group)
+    if user_ids is None:
+        log.debug('Group %s not found!', group)
+        return []
+    return group_mean_time_weekday(user_ids)
+
+
+def date_arg(name, default):
+    """
+    Parses YYYY-MM-DD date from query string, aborts on invalid one.
+    """
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        abort(400)
+
+
+def user_ids_arg():
+    """
+    Parses 'user_id' arguments from query string, aborts on invalid one.
+
+    Returns None when there are none, which stands for all users.
+    """
+    if 'user_id' not in request.args:
+        return None
+    try:
+        return [int(value) for value in request.args.getlist('user_id')]
+    except ValueError:
+        abort(400)
+
+
+@app.route('/api/v1/occupancy', methods=['GET'])
+@jsonify
+def occupancy_view():
+    """
+    Returns mean number of present users in each 15 minutes of a day.
+
+    Days are limited by optional 'from', 'to' dates and 'weekday' number
+    (0 is Monday) given in query string.
+    """
+    start_date = date_arg('from', date.min)
+    end_date = date_arg('to', date.max)
+    weekday = request.args.get('weekday', type=int)
+    if weekday is not None and not 0 <= weekday <= 6:
+        abort(400)
+    return occupancy(start_date, end_date, weekday)
+
+
+@app.route('/api/v1/memory', methods=['GET'])
+@jsonify
+def memory_view():
+    """
+    Returns memory usage of presence data and eviction counters.
+    """
+    return get_memory_stats()
+
+
+@app.route('/api/v1/export/statistics.<export_format>', methods=['GET'])
+def export_statistics_view(export_format):
+    """
+    Streams per user, per weekday statistics as CSV or NDJSON.
+
+    Users can be limited by 'user_id' query string arguments.
+    """
+    if export_format not in EXPORT_FORMATS:
+        abort(404)
+    user_ids = user_ids_arg()
+    return stream_rows(statistics_rows(get_data(), user_ids), export_format)
+
+
+@app.route('/api/v1/export/presence.<export_format>', methods=['GET'])
+def export_presence_view(export_format):
+    """
+    Streams raw presence rows as CSV or NDJSON.
+
+    Rows can be limited by 'user_id' arguments and 'from', 'to' dates given
+    in query string.
+    """
+    if export_format not in EXPORT_FORMATS:
+        abort(404)
+    user_ids = user_ids_arg()
+    rows = presence_rows(
+        get_data(),
+        user_ids,
+        date_arg('from', None),
+        date_arg('to', None),
+    )
+    return stream_rows(rows, export_format)
+
+
+@app.route('/api/v1/anomalies', methods=['GET'])
+@jsonify
+def anomalies_view():
+    """
+    Returns page of days with unusual start or end time.
+
+    Query string takes optional 'user_id', 'page' (from 1) and 'per_page'
+    arguments.
+    """
+    user_id = request.args.get('user_id', type=int)
+    page = request.args.get('page', 1, type=int)
+    per_page = request.args.get('per_page', 50, type=int)
+    if page < 1 or not 1 <= per_page <= 1000:
+        abort(400)
+    anomalies = get_anomalies(user_id)
+    start = (page - 1) * per_page
+    return {
+        'page': page,
+        'per_page': per_page,
+        'total': len(anomalies),
+        'anomalies': anomalies[start:start + per_page],
+    }
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Watching data files for changes.
+
+On Linux changes are reported by inotify, elsewhere files are polled for
+modification time and size changes.
+"""
+
+import os
+import time
+import errno
+import struct
+import select
+import ctypes
+import ctypes.util
+from threading import Thread, Event
+
+from presence_analyzer.storage import source_signature
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=C0103
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_CLOEXEC = 0o2000000
+IN_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def signature(path):
+    """
+    Returns source signature of a file, None if it doesn't exist.
+    """
+    try:
+        return source_signature(path)
+    except OSError:
+        return None
+
+
+class InotifyBackend(object):
+    """
+    Reports changes of watched files using Linux inotify.
+
+    Parent directories are watched, so files replaced by rename are noticed.
+    """
+
+    def __init__(self, paths):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.paths = {}
+        for path in paths:
+            directory, name = os.path.split(os.path.abspath(path))
+            descriptor = libc.inotify_add_watch(self.fd, directory, IN_MASK)
+            if descriptor < 0:
+                os.close(self.fd)
+                raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+            self.paths[(descriptor, name)] = path
+
+    def wait(self, timeout):
+        """
+        Waits up to 'timeout' seconds, returns set of changed paths.
+
+        Events of other files in watched directories don't end waiting.
+        """
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return set()
+            try:
+                ready = select.select([self.fd], [], [], remaining)[0]
+            except select.error as error:
+                if error.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not ready:
+                return set()
+            changed = self.read_events()
+            if changed:
+                return changed
+
+    def read_events(self):
+        """
+        Reads pending events, returns set of watched paths they're about.
+        """
+        changed = set()
+        buf = os.read(self.fd, 4096)
+        offset = 0
+        while offset < len(buf):
+            descriptor, mask, cookie, length = EVENT_HEADER.unpack_from(
+                buf, offset
+            )
+            offset += EVENT_HEADER.size
+            name = buf[offset:offset + length].rstrip('\0')
+            offset += length
+            path = self.paths.get((descriptor, name))
+            if path is not None:
+                changed.add(path)
+        return changed
+
+    def close(self):
+        """
+        Stops watching.
+        """
+        os.close(self.fd)
+
+
+class PollingBackend(object):
+    """
+    Reports changes of watched files by comparing their signatures.
+    """
+
+    def __init__(self, paths):
+        self.signatures = {path: signature(path) for path in paths}
+        self.stopped = Event()
+
+    def wait(self, timeout):
+        """
+        Waits 'timeout' seconds, returns set of changed paths.
+        """
+        self.stopped.wait(timeout)
+        changed = set()
+        for path, old_signature in self.signatures.items():
+            new_signature = signature(path)
+            if new_signature != old_signature:
+                self.signatures[path] = new_signature
+                changed.add(path)
+        return changed
+
+    def close(self):
+        """
+        Stops watching.
+        """
+        self.stopped.set()
+
+
+def make_backend(paths):
+    """
+    Creates inotify backend when it's available, polling one otherwise.
+    """
+    try:
+        return InotifyBackend(paths)
+    except (OSError, AttributeError):
+        log.info('Inotify is not available, polling files', exc_info=True)
+        return PollingBackend(paths)
+
+
+class Watcher(Thread):
+    """
+    Daemon thread calling 'callback' with list of changed paths.
+
+    Callback is called once changes stop for 'delay' seconds, so a file
+    written in many chunks triggers one call.
+    """
+
+    def __init__(self, paths, callback, delay=1, backend=None):
+        super(Watcher, self).__init__(name='watcher')
+        self.daemon = True
+        self.callback = callback
+        self.delay = delay
+        self.backend = backend or make_backend(paths)
+        self.stopped = Event()
+
+    def run(self):
+        """
+        Waits for changes until watcher is stopped.
+        """
+        pending = set()
+        while not self.stopped.is_set():
+            changed = self.backend.wait(self.delay)
+            if changed:
+                pending.update(changed)
+                continue
+            if pending and not self.stopped.is_set():
+                try:
+                    self.callback(sorted(pending))
+                except Exception:  # pylint: disable=W0703
+                    log.exception('Refreshing %s failed', sorted(pending))
+                pending = set()
+        self.backend.close()
+
+    def stop(self):
+        """
+        Stops watching, pending changes are dropped.
+        """
+        self.stopped.set()